@@ -26,7 +26,8 @@ def __to_unit_torch__(x, cuda):
     return (x.transpose(0, 1) / torch.norm(x, p=2, dim=1)).transpose(0,1)
 
 class GlobalMatcher:
-    def __init__(self, method, n_neighbors, unit_vectors=False, buckets=5):
+    def __init__(self, method, n_neighbors, unit_vectors=False, buckets=5, use_gpu=False):
+        self.use_gpu = use_gpu
         if method == 'LSH':
             self.match = lambda x,y: self.__LSH__(x, y, buckets, n_neighbors)
         elif method == 'exact':
@@ -59,9 +60,26 @@ class GlobalMatcher:
         k = np.array([k[i,a] for i, a in enumerate(intm)])
         return k
             
+    """
+    Exact euclidean kNN. Uses faiss if installed (on gpu if use_gpu is set), otherwise scikit-learn.
+    """
     def __exact__(self, global_features, query_global_desc, n_neighbors):
-        nbrs = NearestNeighbors(n_neighbors=n_neighbors).fit(global_features)
-        distances, indices = nbrs.kneighbors(query_global_desc)
+        try:
+            import faiss
+        except ImportError:
+            faiss = None
+        if faiss is None:
+            nbrs = NearestNeighbors(n_neighbors=n_neighbors).fit(global_features)
+            distances, indices = nbrs.kneighbors(query_global_desc)
+            return indices
+        global_features = np.ascontiguousarray(global_features, dtype=np.float32)
+        query_global_desc = np.ascontiguousarray(query_global_desc, dtype=np.float32)
+        if self.use_gpu and hasattr(faiss, 'StandardGpuResources'):
+            index = faiss.GpuIndexFlatL2(faiss.StandardGpuResources(), global_features.shape[1])
+        else:
+            index = faiss.IndexFlatL2(global_features.shape[1])
+        index.add(global_features)
+        distances, indices = index.search(query_global_desc, n_neighbors)
         return indices
       
             
@@ -90,17 +108,32 @@ class GlobalMatcher:
         return np.array(indices)
 
 class LocalMatcher:
-    def __init__(self, ratio_thresh=.75, method='OpenCV', unit_vectors=False):
+    def __init__(self, ratio_thresh=.75, method='OpenCV', unit_vectors=False, fp16=False, opencl=False):
         self.ratio_thresh = ratio_thresh
         self.method = method
+        ## OpenCV transparent API: descriptors wrapped in UMat are matched by the OpenCL kernels of BFMatcher (falls back to cpu without OpenCL device)
+        ## OpenCL itself is switched on by the caller (cv2.ocl.setUseOpenCL), the matcher does not change process wide settings
+        self.opencl = opencl and method == 'OpenCV' and cv2.ocl.haveOpenCL()
+        ## half precision cosine distances on gpu (unit vectors only, squared euclidean distances would overflow)
+        self.fp16 = fp16
+        ## upper bound of distances computed at once by the batched torch matching
+        self.max_elements = 2**27
         if method == 'OpenCV':
-            self.match = lambda x,y: self.__bf_matching__(x, y)
+            self.match_with_ratios = lambda x,y: self.__bf_matching__(x, y)
+        elif method == 'exact_torch':
+            self.match_with_ratios = lambda x,y: self.__batched_torch__(x, [y], torch.cuda.is_available(), exact=True)[0]
         elif method == 'approx':
-            self.match = lambda x,y: self.__approx_np__(y, x, unit_vectors)
+            self.match_with_ratios = lambda x,y: self.__approx_np__(y, x, unit_vectors)
         elif method == 'approx_torch':
-            self.match = lambda x,y: self.__approx_torch__(x,y,torch.cuda.is_available(), unit_vectors)
+            self.match_with_ratios = lambda x,y: self.__approx_torch__(x,y,torch.cuda.is_available(), unit_vectors)
         else:
             raise NotImplementedError('Requested Matching method not implemented')
+        ## match_with_ratios additionally returns the ratio of best to second best distance of every match (lower is better)
+        self.match = lambda x,y: self.match_with_ratios(x,y)[0]
+        ## torch methods match all descriptor sets of a cluster at once
+        self.batched = method in ['exact_torch', 'approx_torch']
+        if self.batched:
+            self.match_many_with_ratios = lambda x, ys, double=False: self.__batched_torch__(x, ys, torch.cuda.is_available(), exact=method == 'exact_torch', is_unit_vector=unit_vectors, double=double)
             
 
         
@@ -110,13 +143,18 @@ class LocalMatcher:
     """
     def __bf_matching__(self, x, y):
         matcher = cv2.BFMatcher.create(cv2.NORM_L2)
-        matches = matcher.knnMatch(y, x, k=2)
+        if self.opencl:
+            matches = matcher.knnMatch(cv2.UMat(np.ascontiguousarray(y, dtype=np.float32)), cv2.UMat(np.ascontiguousarray(x, dtype=np.float32)), k=2)
+        else:
+            matches = matcher.knnMatch(y, x, k=2)
         good = []
+        ratios = []
         for i,(m,n) in enumerate(matches):
             if m.distance < self.ratio_thresh*n.distance:
                 good.append(m)
+                ratios.append(m.distance/n.distance)
         matches = np.array([[g.trainIdx, g.queryIdx] for g in good])
-        return matches
+        return matches, np.array(ratios)
     
     """
     An approximation that only considers direction of a feature vector but not its length
@@ -131,35 +169,80 @@ class LocalMatcher:
         intm = np.argsort(np.array([d[i, ap[i]] for i in range(ap.shape[0])]), axis=1)
         k = np.array([ap[i,a] for i, a in enumerate(intm)])
         matches = []
+        ratios = []
         for i, (m, n) in enumerate(k):
             if d[i, m] < self.ratio_thresh**2*d[i, n]:
                 matches.append([i, m])
-        return np.array(matches)
+                ratios.append(d[i, m]/d[i, n])
+        return np.array(matches), np.array(ratios)
     
 
     """
     Same idea as approx numpy. Especially fast if gpu/cuda available.
     """
     def __approx_torch__(self, x,y,cuda,is_unit_vector=False):
-        if not is_unit_vector:
-            x = __to_unit_torch__(x, cuda)
-            y = __to_unit_torch__(y, cuda)
+        return self.__batched_torch__(x, [y], cuda, exact=False, is_unit_vector=is_unit_vector)[0]
+
+    """
+    Matches x against every descriptor set in ys at once. The sets are zero padded to equal length and
+    compared with one batched matrix product per chunk (chunks are limited to max_elements distances).
+    exact: euclidean distances and ratio test per descriptor of y (same as OpenCV), otherwise
+    cosine distances of unit vectors and ratio test per descriptor of x (same as approx).
+    double: only keep matches whose x descriptor also passes the ratio test in the other direction.
+    Returns a list of (matches, ratios) per entry of ys.
+    """
+    def __batched_torch__(self, x, ys, cuda, exact=False, is_unit_vector=True, double=False):
+        device = torch.device('cuda' if cuda else 'cpu')
+        half = self.fp16 and cuda and not exact
+        results = []
         with torch.no_grad():
-            y = y.transpose(0,1)
-            #print('Memory needed: {:.1f} GiB'.format(round((x.element_size() * x.nelement())/(1024*1024*1024), 1)))
-            #print('Memory needed: {:.1f} GiB'.format((y.element_size() * y.nelement())/(1024*1024*1024)))
-            #d = 1. - torch.einsum('ik,kj->ij', [x, y])
-            d = 1. - torch.matmul(x, y)
-            values, indices = torch.topk(d, 2, dim=1, largest=False, sorted=True)
-            valid = values[:,0] < self.ratio_thresh**2*values[:,1]
-            if not torch.any(valid):
-                return np.array([])
-            indices_valid = indices[valid][:,0]
-            if cuda:
-                valid_indices = torch.arange(valid.size()[0]).cuda()[valid]
-            else:
-                valid_indices = torch.arange(valid.size()[0])[valid]
-            ret = torch.stack([torch.Tensor([valid_indices[i], indices_valid[i]]) for i in range(valid_indices.shape[0])])
-            return ret.cpu().numpy().astype(np.int64) if cuda else ret.numpy().astype(np.int64)
-        
-        
\ No newline at end of file
+            x = torch.as_tensor(x).to(device).float()
+            if not exact and not is_unit_vector:
+                x = x / torch.norm(x, p=2, dim=1, keepdim=True)
+            if half:
+                x = x.half()
+            start = 0
+            while start < len(ys):
+                end, max_len = start + 1, ys[start].shape[0]
+                while end < len(ys) and (end + 1 - start)*max(max_len, ys[end].shape[0])*x.shape[0] <= self.max_elements:
+                    max_len = max(max_len, ys[end].shape[0])
+                    end += 1
+                chunk = [torch.as_tensor(y).to(device).float() for y in ys[start:end]]
+                Y = torch.zeros(len(chunk), max_len, x.shape[1], device=device, dtype=x.dtype)
+                for b, y in enumerate(chunk):
+                    Y[b, :y.shape[0]] = y
+                if not exact and not is_unit_vector:
+                    Y = Y / torch.norm(Y, p=2, dim=2, keepdim=True).clamp(min=1e-12)
+                lengths = torch.tensor([y.shape[0] for y in chunk], device=device)
+                padded = torch.arange(max_len, device=device)[None, :] >= lengths[:, None]
+                ## (B, len(x), max_len)
+                d = torch.matmul(x[None], Y.transpose(1, 2))
+                if exact:
+                    d = (torch.sum(x**2, dim=1)[None, :, None] + torch.sum(Y**2, dim=2)[:, None, :] - 2*d).clamp(min=0).sqrt()
+                else:
+                    d = 1. - d
+                thresh = self.ratio_thresh if exact else self.ratio_thresh**2
+                per_x, per_y = double or not exact, double or exact
+                if per_x:
+                    ## best two y descriptors per x descriptor (padding excluded)
+                    values_x, indices_x = torch.topk(d.masked_fill(padded[:, None, :], float('inf')), 2, dim=2, largest=False, sorted=True)
+                if per_y:
+                    ## best two x descriptors per y descriptor
+                    values_y, indices_y = torch.topk(d, 2, dim=1, largest=False, sorted=True)
+                for b, y in enumerate(chunk):
+                    n = y.shape[0]
+                    if per_x:
+                        valid_x = values_x[b, :, 0] < thresh*values_x[b, :, 1]
+                        pairs_x = (torch.nonzero(valid_x)[:, 0], indices_x[b, :, 0][valid_x], values_x[b, :, 0][valid_x]/values_x[b, :, 1][valid_x])
+                    if per_y:
+                        valid_y = values_y[b, 0, :n] < thresh*values_y[b, 1, :n]
+                        pairs_y = (indices_y[b, 0, :n][valid_y], torch.nonzero(valid_y)[:, 0], values_y[b, 0, :n][valid_y]/values_y[b, 1, :n][valid_y])
+                    ix, iy, ratios = [p.cpu().numpy() for p in (pairs_y if exact else pairs_x)]
+                    ratios = ratios.astype(np.float32)
+                    if double:
+                        reverse = pairs_x if exact else pairs_y
+                        mask = np.isin(ix, reverse[0].cpu().numpy())
+                        ix, iy, ratios = ix[mask], iy[mask], ratios[mask]
+                    results.append((np.stack([ix, iy], axis=1).astype(np.int64), ratios))
+                start = end
+        return results
@@ -1,7 +1,7 @@
 import numpy as np
 import argparse
 import time
-from models.cirtorch_utils.genericdataset import ImagesFromList
+from models.cirtorch_utils.imagedataset import ImagesFromList
 from evaluate import get_files, time_to_str
 
 parser = argparse.ArgumentParser()
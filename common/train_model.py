@@ -10,6 +10,7 @@ from datetime import timedelta
 from common.utils import VisdomLinePlotter
 
 from torch_geometric.data import Data
+from models.cirtorch_utils.genericdataset import float_pos_batch
 
 from common.scheduler import LearningRateScheduler
 
@@ -114,8 +115,7 @@ def train_triplet(ptnet, cnn2d, dataset, config, args, **kwargs):
                 if i > n_val:
                     break
                 if CUDA:
-                    for j in range(len(data)):
-                        data[j] = data[j].to(device)
+                    data = batch_to_device(data, device)
                     #data[0] = data[0].cuda()
                     #data[1] = data[1].to(device)#Data(pos=data[1].cuda(), batch=torch.cuda.LongTensor([0]*data[1].size(0)))
                     #data[2] = data[2].to(device)#Data(pos=data[2].cuda(), batch=torch.cuda.LongTensor([0]*data[2].size(0)))
@@ -143,8 +143,7 @@ def train_triplet(ptnet, cnn2d, dataset, config, args, **kwargs):
             if i > n_samples: ##overfit
                 break
             if CUDA:
-                for j in range(len(data)):
-                    data[j] = data[j].to(device)
+                data = batch_to_device(data, device)
                 #data[0] = data[0].cuda()
                 #data[1] = data[1].to(device)#Data(pos=data[1].cuda(), batch=torch.cuda.LongTensor([0]*data[1].size(0)))
                 #data[2] = data[2].to(device)#Data(pos=data[2].cuda(), batch=torch.cuda.LongTensor([0]*data[2].size(0)))
@@ -186,8 +185,7 @@ def train_triplet(ptnet, cnn2d, dataset, config, args, **kwargs):
             if i > n_val:
                 break
             if CUDA:
-                for j in range(len(data)):
-                    data[j] = data[j].to(device)
+                data = batch_to_device(data, device)
                 #data[0] = data[0].cuda()
                 #data[1] = data[1].to(device)#Data(pos=data[1].cuda(), batch=torch.cuda.LongTensor([0]*data[1].size(0)))
                 #data[2] = data[2].to(device)#Data(pos=data[2].cuda(), batch=torch.cuda.LongTensor([0]*data[2].size(0)))
@@ -211,6 +209,11 @@ def train_triplet(ptnet, cnn2d, dataset, config, args, **kwargs):
     ## Save training
     save_checkpoint(epoch, n_epochs, [ptnet, cnn2d], optim, base_dir)
             
+## dense image tensors come pinned from PCDataLoader, so their copy is asynchronous and overlaps with compute
+## point cloud batches (torch_geometric) are moved with their own .to, float16 point clouds are upcast after the copy
+def batch_to_device(data, device):
+    return [d.to(device, non_blocking=True) if torch.is_tensor(d) else float_pos_batch(d.to(device)) for d in data]
+
 def step_feedfwd(model, data, target, loss_fn, optim, train=True):
     if train:
         optim.zero_grad()
@@ -88,10 +88,10 @@ class Cambridge(data.Dataset):
         
         pt_ids = self.imgs[index].point3D_ids
         pts3d = np.vstack([self.pts[i].xyz for i in pt_ids])
-        mean, std = np.mean(pts3d, axis=0), np.std(pts3d, axis=0)
+        ## with demean=False the point clouds can be normalized batched after collation (PCDataLoader(demean=True))
         if self.demean:
-            pts3d -= mean
-            pts3d /= std
+            pts3d -= np.mean(pts3d, axis=0)
+            pts3d /= np.std(pts3d, axis=0)
         pts3d = torch.from_numpy(pts3d).float()
         return img, pts3d
     
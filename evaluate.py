@@ -13,18 +13,25 @@ Please see Note in README
 """
 
 import argparse
+import contextlib
 import os
+import sys
 import numpy as np
 import torch
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from torchvision import transforms
 import cv2
+import imageio
 import time
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import functools
 import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+import scipy.sparse
 from fnmatch import fnmatch
-from pyquaternion import Quaternion
 import warnings
 import transforms3d.quaternions as txq
 
@@ -36,6 +43,8 @@ import models.netvlad_vd16_pitts30k_conv5_3_max_dag as netvlad
 import models.demo_superpoint as superpoint
 from models.d2net.extract_features import d2net_interface
 from models.cirtorch_network import init_network, extract_vectors
+from models.cirtorch_utils.imagedataset import ImagesFromList
+from models.cirtorch_utils.datahelpers import ToNormalizedTensor
 
 
 parser = argparse.ArgumentParser()
@@ -44,15 +53,27 @@ parser.add_argument('--local_method', default='Colmap', choices=['Colmap', 'Supe
 parser.add_argument('--colmap_query_database', default='data/queries.db', help='Database to colmap sift features if colmap is used as local method')
 parser.add_argument('--database_path', default='data/AachenDayNight/aachen.db', help='Path to colmap database')
 parser.add_argument('--global_features_db', default='data/global_features_low_res.db', help='Database for global features of database images')
+parser.add_argument('--preload_features', action='store_true', help='Read all colmap keypoints and descriptors of the database into memory during setup')
+parser.add_argument('--feature_cache', default=1024, type=int, help='Number of database images whose local features are cached in memory (~1MB per image for colmap sift, 0 disables the cache)')
 parser.add_argument('--desc_database', default=None, help='If neural model (d2/superpoint) is used precalculated database descriptors speed everything up') 
 parser.add_argument('--local_model_path', default='data/teacher_models/superpoint_v1.pth', help='Path to pretrained local descriptor model')
 parser.add_argument('--nearest_method', default='approx', type = str, choices=['exact', 'LSH', 'approx'], help='Which method to use to find nearest global neighbors')
 parser.add_argument('--local_matching_method', default='approx', type=str, choices=['exact', 'approx'], help='How local features are matched. Approx only considers direction of feature vector but is much faster.')
 parser.add_argument('--global_resolution', default=224, type=int, help='Resolution on which nearest global neighbors are calculated')
+parser.add_argument('--fp16', action='store_true', help='Extract global descriptors with fp16 autocast (requires CUDA and PyTorch >= 1.6)')
+parser.add_argument('--fp16_matching', action='store_true', help='Match local descriptors with fp16 cosine distances (requires CUDA and approx local matching)')
+parser.add_argument('--opencl', action='store_true', help='Run exact OpenCV local matching (no CUDA) on an OpenCL device if available')
+parser.add_argument('--batch_size', default=32, type=int, help='Number of query images processed at once during descriptor extraction')
+parser.add_argument('--num_workers', default=4, type=int, help='Number of worker processes loading query images')
+parser.add_argument('--query_chunk', default=256, type=int, help='Number of query images whose local features are extracted (and held in memory) at once')
+parser.add_argument('--workers', default=1, type=int, help='Number of workers matching and localizing queries in parallel, 1 runs serially (0: one per cpu)')
+parser.add_argument('--pool', default='process', choices=['process', 'thread'], help='Run parallel queries (--workers > 1) in processes or threads')
 parser.add_argument('--augmentation', action='store_true', help='Use augmented images')
 parser.add_argument('--ratio_thresh', type=float, default=.75, help='Threshold for local feature matching in range [0.0, 1.0]. The higher it is the less similar matches have to be.')
 parser.add_argument('--n_iter', type=int, default=5000, help='Number of iterations in RANSAC loop')
 parser.add_argument('--reproj_error', type=float, default=8., help='Reprojection error of PnP-RANSAC loop')
+parser.add_argument('--pnp_backend', default='opencv', choices=['opencv', 'poselib'], help='Library used for PnP-RANSAC (poselib has to be installed separately)')
+parser.add_argument('--pnp_flags', default='p3p', choices=['p3p', 'prosac'], help='Solver of the OpenCV PnP-RANSAC. prosac (USAC) requires OpenCV >= 4.5 and exploits the ordering of the matches')
 parser.add_argument('--min_inliers', type=int, default=5, help='minimal number of inliers after PnP-RANSAC')
 parser.add_argument('--n_neighbors', default=20, type=int, help='How many global neighbors are used')
 parser.add_argument('--buckets', default=5, type=int, help='How many buckets are used for LSH hashing (Note: num of buckets = 2^(argument))')
@@ -66,21 +87,64 @@ parser.add_argument('--bidirectional_filtering', action='store_true', help='Filt
 
 
 
+"""
+Batched version of qvec2rotmat: (N,4) quaternions (w,x,y,z) -> (N,3,3) rotation matrices
+"""
+def qvecs2rotmats(Q):
+    Q = np.asarray(Q, dtype=np.float64).reshape(-1, 4)
+    w, x, y, z = Q[:,0], Q[:,1], Q[:,2], Q[:,3]
+    xx, yy, zz = x*x, y*y, z*z
+    xy, xz, yz = x*y, x*z, y*z
+    wx, wy, wz = w*x, w*y, w*z
+    R = np.empty((Q.shape[0], 3, 3))
+    R[:,0,0] = 1 - 2*(yy + zz)
+    R[:,0,1] = 2*(xy - wz)
+    R[:,0,2] = 2*(xz + wy)
+    R[:,1,0] = 2*(xy + wz)
+    R[:,1,1] = 1 - 2*(xx + zz)
+    R[:,1,2] = 2*(yz - wx)
+    R[:,2,0] = 2*(xz - wy)
+    R[:,2,1] = 2*(yz + wx)
+    R[:,2,2] = 1 - 2*(xx + yy)
+    return R
+
 ## Taken from original hfnet repository
 def qvec2rotmat(qvec):
-    return np.array([
-        [1 - 2 * qvec[2]**2 - 2 * qvec[3]**2,
-         2 * qvec[1] * qvec[2] - 2 * qvec[0] * qvec[3],
-         2 * qvec[3] * qvec[1] + 2 * qvec[0] * qvec[2]],
-        [2 * qvec[1] * qvec[2] + 2 * qvec[0] * qvec[3],
-         1 - 2 * qvec[1]**2 - 2 * qvec[3]**2,
-         2 * qvec[2] * qvec[3] - 2 * qvec[0] * qvec[1]],
-        [2 * qvec[3] * qvec[1] - 2 * qvec[0] * qvec[2],
-         2 * qvec[2] * qvec[3] + 2 * qvec[0] * qvec[1],
-        1 - 2 * qvec[1]**2 - 2 * qvec[2]**2]])
+    return qvecs2rotmats(np.asarray(qvec)[None])[0]
+
+"""
+Batched Shepperd method: (N,3,3) -> (N,4) quaternions (w,x,y,z) with w >= 0
+all four candidate quaternions are built at once, the one with the largest (most stable) pivot is selected without branching
+"""
+def rotmats2qvecs(R):
+    R = np.asarray(R, dtype=np.float64).reshape(-1, 3, 3)
+    Rxx, Ryy, Rzz = R[:,0,0], R[:,1,1], R[:,2,2]
+    t = Rxx + Ryy + Rzz
+    wx, wy, wz = R[:,2,1] - R[:,1,2], R[:,0,2] - R[:,2,0], R[:,1,0] - R[:,0,1]
+    xy, xz, yz = R[:,0,1] + R[:,1,0], R[:,0,2] + R[:,2,0], R[:,1,2] + R[:,2,1]
+    ## candidates (N,4,4), row k is 4*q_k*q
+    C = np.stack([
+        np.stack([1 + t, wx, wy, wz], axis=1),
+        np.stack([wx, 1 + 2*Rxx - t, xy, xz], axis=1),
+        np.stack([wy, xy, 1 + 2*Ryy - t, yz], axis=1),
+        np.stack([wz, xz, yz, 1 + 2*Rzz - t], axis=1)], axis=1)
+    pivot = np.argmax(np.diagonal(C, axis1=1, axis2=2), axis=1)
+    Q = C[np.arange(R.shape[0]), pivot]
+    Q /= np.linalg.norm(Q, axis=1, keepdims=True)
+    Q *= np.where(Q[:,0] < 0, -1.0, 1.0)[:,None]
+    return Q
+
+def rotmat2qvec_fast(R):
+    return rotmats2qvecs(R)[0]
 
+"""
+strict: use the eigendecomposition from the original hfnet repository,
+which is also robust for non-orthonormal matrices and rotations close to 180 degrees
+"""
 ## Taken from original hfnet repository
-def rotmat2qvec(R):
+def rotmat2qvec(R, strict=False):
+    if not strict:
+        return rotmat2qvec_fast(R)
     Rxx, Ryx, Rzx, Rxy, Ryy, Rzy, Rxz, Ryz, Rzz = R.flat
     K = np.array([
         [Rxx - Ryy - Rzz, 0, 0, 0],
@@ -93,15 +157,56 @@ def rotmat2qvec(R):
         qvec *= -1
     return qvec
 
+"""
+Rodrigues formula: rotation vector (3,) -> rotation matrix (3,3)
+"""
+def rvec_to_rotmat(rvec):
+    rvec = np.asarray(rvec, dtype=np.float64).ravel()
+    theta = np.sqrt(rvec.dot(rvec))
+    if theta < 1e-12:
+        return np.eye(3)
+    kx, ky, kz = rvec/theta
+    K = np.array([[0, -kz, ky], [kz, 0, -kx], [-ky, kx, 0]])
+    return np.eye(3) + np.sin(theta)*K + (1 - np.cos(theta))*K.dot(K)
+
+"""
+Camera position in world coordinates and quaternion (w,x,y,z) of the world to camera transform R, t.
+Uses the rigid inverse [R^T, -R^T t] instead of inverting the 4x4 transform.
+"""
+def rotation_translation_to_pose_and_quat(R, t):
+    position = -R.T.dot(np.asarray(t, dtype=np.float64).ravel())
+    return position, rotmat2qvec_fast(R)
+
 ## Taken from original hfnet repository
 def colmap_image_to_pose(image):
     im_T_w = np.eye(4)
-    im_T_w[:3, :3] = qvec2rotmat(image.qvec)
+    im_T_w[:3, :3] = image.R if hasattr(image, 'R') else qvec2rotmat(image.qvec)
     im_T_w[:3, 3] = image.tvec
     w_T_im = np.linalg.inv(im_T_w)
     return w_T_im
+"""
+Keeps hot index pages in ram (memory mapped io, 200MB page cache)
+"""
 def get_cursor(name):
-    return sqlite3.connect(name).cursor()
+    connection = sqlite3.connect(name)
+    connection.execute('PRAGMA mmap_size=1073741824;')
+    connection.execute('PRAGMA cache_size=-200000;')
+    connection.execute('PRAGMA temp_store=MEMORY;')
+    return connection.cursor()
+
+"""
+Batched select of the given columns for several images: {image_id: (column values)}
+"""
+def rows_from_db(cursor, table, columns, image_ids):
+    image_ids = list(image_ids)
+    rows = {}
+    ## old sqlite versions allow at most 999 parameters per statement
+    for i in range(0, len(image_ids), 999):
+        chunk = image_ids[i:i+999]
+        cursor.execute('SELECT image_id, {} FROM {} WHERE image_id IN ({});'.format(columns, table, ','.join('?'*len(chunk))), chunk)
+        for row in cursor:
+            rows[row[0]] = row[1:]
+    return rows
 
 ## Taken from original hfnet repository
 def descriptors_from_colmap_db(cursor, image_id):
@@ -118,6 +223,111 @@ def keypoints_from_colmap_db(cursor, image_id):
     kpts = np.frombuffer(blob, dtype=np.float32).reshape(-1, cols)[:, :2]
     return kpts
 
+"""
+Least recently used cache of per image arrays {image_id: array}.
+Missing images are read with a single call of fetch_many (e.g. one batched select).
+"""
+class FeatureCache:
+    def __init__(self, fetch_many, maxsize=4096):
+        self.fetch_many = fetch_many
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get_many(self, image_ids):
+        image_ids = list(image_ids)
+        if self.maxsize <= 0:
+            return self.fetch_many(image_ids)
+        missing = [i for i in set(image_ids) if i not in self.entries]
+        fetched = self.fetch_many(missing) if len(missing) > 0 else {}
+        result = {}
+        for i in image_ids:
+            if i in fetched:
+                result[i] = fetched[i]
+                self.entries[i] = fetched[i]
+            else:
+                result[i] = self.entries[i]
+                self.entries.move_to_end(i)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return result
+
+    ## same entries, but own fetch function (e.g. cursor of another thread)
+    def copy(self, fetch_many):
+        cache = FeatureCache(fetch_many, self.maxsize)
+        cache.entries = OrderedDict(self.entries)
+        return cache
+
+    ## prewarm with the images needed first
+    def prefetch(self, image_ids):
+        self.get_many(list(OrderedDict.fromkeys(image_ids))[:self.maxsize])
+
+def local_descriptors_from_db(cursor, image_ids):
+    rows = rows_from_db(cursor, 'local_features', 'cols, desc', image_ids)
+    return {i: np.frombuffer(d, dtype=np.float32).reshape(c, -1) for i, (c, d) in rows.items()}
+
+"""
+Keypoints and descriptors of colmap database images.
+With preload all features are read in a single pass instead of one query per image,
+otherwise the last cache_size images are kept in memory.
+"""
+class ColmapFeatures:
+    def __init__(self, cursor, preload=False, cache_size=0):
+        self.cursor = cursor
+        self.kpts = None
+        self.desc = None
+        self.kpts_cache = FeatureCache(self.fetch_keypoints, cache_size)
+        self.desc_cache = FeatureCache(self.fetch_descriptors, cache_size)
+        if preload:
+            self.kpts = {}
+            for image_id, cols, blob in cursor.execute('SELECT image_id, cols, data FROM keypoints;'):
+                self.kpts[image_id] = np.frombuffer(blob, dtype=np.float32).reshape(-1, cols)[:, :2]
+            self.desc = {}
+            for image_id, cols, blob in cursor.execute('SELECT image_id, cols, data FROM descriptors;'):
+                self.desc[image_id] = np.frombuffer(blob, dtype=np.uint8).reshape(-1, cols)
+
+    ## sqlite cursors can not be pickled, worker processes open their own
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cursor'] = None
+        return state
+
+    ## shares preloaded and cached features, but reads from another cursor
+    def clone(self, cursor):
+        features = ColmapFeatures.__new__(ColmapFeatures)
+        features.__dict__.update(self.__dict__)
+        features.cursor = cursor
+        features.kpts_cache = self.kpts_cache.copy(features.fetch_keypoints)
+        features.desc_cache = self.desc_cache.copy(features.fetch_descriptors)
+        return features
+
+    def keypoints(self, image_id):
+        if self.kpts is not None:
+            return self.kpts[image_id]
+        return keypoints_from_colmap_db(self.cursor, image_id)
+
+    def descriptors(self, image_id):
+        if self.desc is not None:
+            return self.desc[image_id]
+        return descriptors_from_colmap_db(self.cursor, image_id)
+
+    def fetch_keypoints(self, image_ids):
+        rows = rows_from_db(self.cursor, 'keypoints', 'cols, data', image_ids)
+        return {i: np.frombuffer(blob, dtype=np.float32).reshape(-1, cols)[:, :2] for i, (cols, blob) in rows.items()}
+
+    def fetch_descriptors(self, image_ids):
+        rows = rows_from_db(self.cursor, 'descriptors', 'cols, data', image_ids)
+        return {i: np.frombuffer(blob, dtype=np.uint8).reshape(-1, cols) for i, (cols, blob) in rows.items()}
+
+    def keypoints_many(self, image_ids):
+        if self.kpts is not None:
+            return {i: self.kpts[i] for i in image_ids}
+        return self.kpts_cache.get_many(image_ids)
+
+    def descriptors_many(self, image_ids):
+        if self.desc is not None:
+            return {i: self.desc[i] for i in image_ids}
+        return self.desc_cache.get_many(image_ids)
+
 def get_kpts_desc(cursor, image_id):
     image_id = int(image_id)
     kpts = keypoints_from_colmap_db(cursor, image_id)[:, :2]
@@ -139,12 +349,28 @@ def kpts_to_cv(kpts, kpt_size=1.0):
         cv_kpts.append(cv2.KeyPoint(x=kpt[0], y=kpt[1], _size=kpt_size))
     return cv_kpts
 
+"""
+Recursively collects files matching pattern (same order as os.walk).
+Patterns of the form '*.jpg' are checked as plain suffix instead of fnmatch.
+"""
 def get_files(path, pattern, not_pattern = None, printout=False):
+    if pattern.startswith('*') and not any(c in pattern[1:] for c in '*?['):
+        suffix = pattern[1:]
+        matches = lambda name: name.endswith(suffix)
+    else:
+        matches = lambda name: fnmatch(name, pattern)
     found = []
-    for path, subdirs, files in os.walk(path):
-        for name in files:
-            if fnmatch(name, pattern) and (not_pattern is None or not fnmatch(name, not_pattern)):
-                found.append(os.path.join(path, name))
+    stack = [path]
+    while stack:
+        subdirs = []
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif matches(entry.name) and (not_pattern is None or not fnmatch(entry.name, not_pattern)):
+                    found.append(entry.path)
+        stack += reversed(subdirs)
     if printout:
         print("Found %d files in path %s"%(len(found), path))
     return found
@@ -154,18 +380,15 @@ def get_files(path, pattern, not_pattern = None, printout=False):
 Transforms errors into percentage format used in visuallocalization.net
 """
 def percentage_stats(errors_trans, errors_rot, day=True):
-    num_high, num_medium, num_coarse = 0,0,0
-    for t, q in zip(errors_trans, errors_rot):
-        if day and t <= 0.25 and q <= 2.0:
-            num_high += 1
-        elif not day and t <= 0.5 and q <= 2.0:
-            num_high += 1
-        if day and t <= 0.5 and q <= 5.0:
-            num_medium += 1
-        elif not day and t <= 1.0 and q <= 5.0:
-            num_medium += 1
-        if t <= 5.0 and q <= 10.0:
-            num_coarse += 1
+    t = np.asarray(errors_trans)
+    q = np.asarray(errors_rot)
+    if day:
+        num_high = np.sum((t <= 0.25) & (q <= 2.0))
+        num_medium = np.sum((t <= 0.5) & (q <= 5.0))
+    else:
+        num_high = np.sum((t <= 0.5) & (q <= 2.0))
+        num_medium = np.sum((t <= 1.0) & (q <= 5.0))
+    num_coarse = np.sum((t <= 5.0) & (q <= 10.0))
     per_high = float(num_high)/float(len(errors_trans))*100.0
     per_medium = float(num_medium)/float(len(errors_trans))*100.0
     per_coarse = float(num_coarse)/float(len(errors_trans))*100.0
@@ -209,148 +432,300 @@ def calc_neighbor_match(img_idx, neighbor_idx, images):
     oimg = images[img_idx]
     nimg = images[neighbor_idx]
 
-    valid_o = oimg.point3D_ids > 0 
-    pt_ids_o = oimg.point3D_ids[valid_o]
+    pt_ids_o = oimg.pt_ids
+    pt_ids_n = nimg.pt_ids
 
-    valid_n = nimg.point3D_ids > 0 
-    pt_ids_n = nimg.point3D_ids[valid_n]
-
-    shared = np.isin(pt_ids_o, pt_ids_n)
-    pt_ids_s = pt_ids_o[shared]
+    ## a 3d point is observed at most once per image
+    pt_ids_s = np.intersect1d(pt_ids_o, pt_ids_n, assume_unique=True)
     #print('Images match {:.1f}%'.format(100.0*(pt_ids_s.shape[0]/pt_ids_o.shape[0])))
     return 100.0*(pt_ids_s.shape[0]/min([pt_ids_o.shape[0], pt_ids_n.shape[0]]))
 
+"""
+Sparse image x 3d point incidence of all images, rows are the sorted image ids.
+rows[image_id] is the matrix row of an image (-1 for unknown ids), so a list of neighbors is looked up with one take.
+The product of two rows counts shared 3d points, see calc_neighbor_matches.
+"""
+ImagePointIncidence = namedtuple('ImagePointIncidence', ['rows', 'matrix', 'num_points'])
+def get_image_point_incidence(images):
+    img_keys = sorted(images.keys())
+    pt_ids = [images[i].pt_ids for i in img_keys]
+    num_points = np.array([p.shape[0] for p in pt_ids], dtype=np.int64)
+    _, cols = np.unique(np.concatenate(pt_ids), return_inverse=True)
+    data_rows = np.repeat(np.arange(len(img_keys)), num_points)
+    matrix = scipy.sparse.csr_matrix((np.ones(cols.shape[0], dtype=np.int32), (data_rows, cols)), shape=(len(img_keys), cols.max()+1))
+    rows = np.full(img_keys[-1]+1, -1, dtype=np.int64)
+    rows[img_keys] = np.arange(len(img_keys))
+    return ImagePointIncidence(rows=rows, matrix=matrix, num_points=num_points)
+
+"""
+calc_neighbor_match for all neighbors of an image with a single sparse product
+"""
+def calc_neighbor_matches(img_idx, neighbor_idxs, incidence):
+    o = incidence.rows[img_idx]
+    n = incidence.rows.take(neighbor_idxs)
+    shared = np.asarray(incidence.matrix[n].dot(incidence.matrix[o].T).todense()).ravel()
+    return 100.0*(shared/np.minimum(incidence.num_points[o], incidence.num_points[n]))
+
+"""
+Intrinsics of all query and database images.
+K[name2idx[name]] is the camera matrix, rad_dist[name2idx[name]] the radial distortion and size[name2idx[name]] (w, h) of image name.
+"""
+CameraMatrices = namedtuple('CameraMatrices', ['name2idx', 'K', 'rad_dist', 'size'])
 def get_camera_matrices():
-    camera_matrices = {}
     query_intrinsics_files = ['data/AachenDayNight/queries/day_time_queries_with_intrinsics.txt',
                              'data/AachenDayNight/queries/night_time_queries_with_intrinsics.txt',
                              'data/AachenDayNight/database_intrinsics.txt']
-    for file_path in query_intrinsics_files:
-        with open(file_path, 'r') as f:
-            lines = [l.strip() for l in f.readlines()]
-            for line in lines:
-                # Format: `image_name SIMPLE_RADIAL w h f cx cy r`
-                line = line.split(' ')
-                img_path = line[0]
-                f = float(line[4])
-                cx = float(line[5])
-                cy = float(line[6])
-                rad_dist = float(line[7])
-                A = np.array([[f, 0, cx],[0, f, cy], [0, 0, 1]])
-                camera_matrices[img_path] = {'cameraMatrix': A, 'rad_dist':rad_dist}
-    return camera_matrices
-
-def get_img_cluster(images, points3d):
-    img_cluster = {img: set() for img in images.keys()} 
-    for p_id in points3d.keys(): 
-        img_ids = set(points3d[p_id].image_ids)
-        for img_id in img_ids:
-            img_cluster[img_id] |= img_ids
+    # Format: `image_name SIMPLE_RADIAL w h f cx cy r`
+    lines = np.concatenate([np.loadtxt(file_path, dtype=str, ndmin=2) for file_path in query_intrinsics_files])
+    names = lines[:, 0]
+    size = lines[:, 2:4].astype(np.int64)
+    f, cx, cy, rad_dist = lines[:, 4:8].astype(np.float64).T
+    K = np.zeros((names.shape[0], 3, 3))
+    K[:, 0, 0] = f
+    K[:, 1, 1] = f
+    K[:, 0, 2] = cx
+    K[:, 1, 2] = cy
+    K[:, 2, 2] = 1
+    ## later entries overwrite earlier ones with same name
+    name2idx = {name: i for i, name in enumerate(names.tolist())}
+    return CameraMatrices(name2idx=name2idx, K=K, rad_dist=rad_dist, size=size)
+
+"""
+Augmented night images are stored as png next to the dataset, database image db/x.jpg <-> AugmentedNightImages_high_res/x.png
+"""
+augmented_dir = 'data/AachenDayNight/AugmentedNightImages_high_res/'
+def augmented_path(db_name):
+    return augmented_dir + db_name.replace('db/', '').replace('.jpg', '.png')
+
+def augmented_to_db_name(path):
+    return path.replace(augmented_dir, 'db/').replace('.png', '.jpg')
+
+"""
+Camera parameters of all queries (query_id indexes every array), resolved once before matching.
+Queries with unknown intrinsics (known == False) get the median (backfall) camera.
+"""
+QueryCameras = namedtuple('QueryCameras', ['K', 'rad_dist', 'dist_vecs', 'size', 'known'])
+def get_query_cameras(args, query_images, query_image_ids, images, camera_matrices):
+    idx = np.full(len(query_images), -1, dtype=np.int64)
+    for query_id, query_name in enumerate(query_images):
+        if args.verify is not None:
+            query_path = images[abs(query_image_ids[query_id])].name
+        else:
+            query_path = os.path.join(*os.path.normpath(query_name).split(os.sep)[-4:])
+        if 'Augmented' in query_path:
+            query_path = augmented_to_db_name(query_path)
+        idx[query_id] = camera_matrices.name2idx.get(query_path, -1)
+    known = idx >= 0
+    K = np.empty((len(query_images), 3, 3))
+    K[known] = camera_matrices.K[idx[known]]
+    if not np.all(known):
+        ## the intrinsics are already one stacked (C,3,3) array, the median is a single reduction over it
+        K[~known] = np.median(camera_matrices.K, axis=0)
+    rad_dist = np.where(known, camera_matrices.rad_dist[idx], np.median(camera_matrices.rad_dist))
+    dist_vecs = np.zeros((len(query_images), 4))
+    dist_vecs[:, 0] = rad_dist
+    size = np.where(known[:, None], camera_matrices.size[idx], np.median(camera_matrices.size, axis=0).astype(np.int64))
+    return QueryCameras(K=K, rad_dist=rad_dist, dist_vecs=dist_vecs, size=size, known=known)
+
+"""
+Groundtruth camera positions (Q,3) and quaternions (Q,4) of all verification queries
+"""
+Groundtruth = namedtuple('Groundtruth', ['positions', 'qvecs'])
+def get_groundtruth(images, query_image_ids):
+    ids = [abs(i) for i in query_image_ids]
+    R = np.stack([images[i].R for i in ids])
+    tvecs = np.stack([images[i].tvec for i in ids])
+    ## same as colmap_image_to_pose(image)[:3,3], rigid inverse -R^T t
+    positions = -np.einsum('nji,nj->ni', R, tvecs)
+    return Groundtruth(positions=positions, qvecs=np.stack([images[i].qvec for i in ids]))
+
+"""
+Struct of arrays for all 3d points:
+ids, dense xyz, lookup table from point3D_id to row and observing image ids in CSR layout
+(images of point in row i are image_ids[image_offsets[i]:image_offsets[i+1]])
+"""
+Points3DArrays = namedtuple('Points3DArrays', ['ids', 'xyz', 'lut', 'image_ids', 'image_offsets'])
+def get_point_arrays(points3d):
+    pt_ids = np.array(sorted(points3d.keys()), dtype=np.int64)
+    xyz = np.ascontiguousarray(np.stack([points3d[i].xyz for i in pt_ids]), dtype=np.float64)
+    lut = np.full(pt_ids[-1]+1, -1, dtype=np.int64)
+    lut[pt_ids] = np.arange(pt_ids.shape[0])
+    image_ids = [points3d[i].image_ids for i in pt_ids]
+    image_offsets = np.zeros(pt_ids.shape[0]+1, dtype=np.int64)
+    np.cumsum([ids.shape[0] for ids in image_ids], out=image_offsets[1:])
+    image_ids = np.concatenate(image_ids).astype(np.int64)
+    return Points3DArrays(ids=pt_ids, xyz=xyz, lut=lut, image_ids=image_ids, image_offsets=image_offsets)
+
+"""
+For every image the set of images sharing at least one 3d point with it.
+Computed as non-zero pattern of I*I^T with I being the sparse image x point incidence matrix.
+"""
+def get_img_cluster(images, points):
+    img_keys = np.array(sorted(images.keys()), dtype=np.int64)
+    img_lut = np.full(img_keys[-1]+1, -1, dtype=np.int64)
+    img_lut[img_keys] = np.arange(img_keys.shape[0])
+    rows = img_lut[points.image_ids]
+    cols = np.repeat(np.arange(points.ids.shape[0]), np.diff(points.image_offsets))
+    incidence = scipy.sparse.csr_matrix((np.ones(rows.shape[0], dtype=np.int32), (rows, cols)),
+                                        shape=(img_keys.shape[0], points.ids.shape[0]))
+    covisible = incidence.dot(incidence.T).tocsr()
+    img_cluster = {}
+    for r, img in enumerate(img_keys.tolist()):
+        img_cluster[img] = set(img_keys[covisible.indices[covisible.indptr[r]:covisible.indptr[r+1]]].tolist())
     return img_cluster
 
-def double_matching(local_matcher, query_desc, neighbor_desc):
-    matches_forward = local_matcher.match(query_desc, neighbor_desc)
+"""
+Agglomerates the covisibility clusters of the global neighbors of one query.
+A neighbor that is already part of a cluster extends the first such cluster, otherwise it starts a new one.
+owner maps every image to the first cluster that contains it, so each test is a single lookup.
+"""
+def cluster_neighbors(neighbor_ids, img_cluster):
+    cluster_orig_ids = []
+    members = []
+    owner = {}
+    for ind in neighbor_ids:
+        point_set = img_cluster[ind]
+        j = owner.get(ind)
+        if j is None:
+            j = len(members)
+            cluster_orig_ids.append(ind)
+            members.append([])
+        members[j].append(point_set)
+        for img in point_set:
+            if owner.get(img, j) >= j:
+                owner[img] = j
+    cluster_query = [set().union(*m) for m in members]
+    return cluster_orig_ids, cluster_query
+
+def double_matching(local_matcher, query_desc, neighbor_desc, with_ratios=False):
+    matches_forward, ratios = local_matcher.match_with_ratios(query_desc, neighbor_desc)
     matches_reverse = local_matcher.match(neighbor_desc, query_desc)
     if matches_forward.shape[0] == 0 or matches_reverse.shape[0] == 0:
-        return np.array([])
+        return (np.array([]), np.array([])) if with_ratios else np.array([])
     #print(matches_forward.shape)
     #print(matches_reverse.shape)
-    matches = []
-    mr = list(matches_reverse[:,1])
-    for m in matches_forward:
-        if m[0] in mr:
-            matches.append(m)
-    matches = np.array(matches)
-    return matches
-
-def match_local(args, mm, query_desc, query_kpts, images, points3d, query_id, cluster_query, database_cursor, model, matcher, refilter=False, double=False, desc_database=None):
+    ## keep forward matches whose query keypoint was also matched in reverse direction
+    mask = np.isin(matches_forward[:,0], matches_reverse[:,1])
+    return (matches_forward[mask], ratios[mask]) if with_ratios else matches_forward[mask]
+
+def match_local(args, mm, query_desc, query_kpts, images, points, query_id, query_image_ids, cluster_query, database_features, model, matcher, refilter=False, double=False, desc_database=None, log=None):
     cuda = torch.cuda.is_available()
-    matched_kpts_cv = []
+    matched_kpt_idxs = []
     matched_pts = []
+    matched_ratios = []
     #matcher = cv2.BFMatcher.create(cv2.NORM_L2)
     data_descs = []
     if refilter:
         pt_ids_all = []
         data_descs = []
+    ## approx_torch keeps all descriptors on one device, only match indices are moved back
+    on_torch = mm == 'approx_torch'
+    device = torch.device('cuda' if cuda else 'cpu')
     if 'approx' in mm:
         query_desc = to_unit_vector(query_desc, method=mm, cuda=cuda)
     correct, incorrect = 0, 0
     augments = 0
     if args.verify is not None and args.local_method == 'Colmap':
-        valid_o = images[query_image_ids[query_id]].point3D_ids > 0 
+        valid_o = images[query_image_ids[query_id]].valid
         pt_ids_o = images[query_image_ids[query_id]].point3D_ids
         pt_ids_o = pt_ids_o[:pt_ids_o.shape[0]//2]
+    ## neighbors can be part of several clusters but are matched only once
+    neighbors = []
+    seen = set()
     for c in cluster_query:
         for img in c:
-            if args.verify is not None and abs(img) == abs(query_image_ids[query_id]):
-                continue
-            img_name = images[abs(img)].name
-            valid = images[abs(img)].point3D_ids > 0 
-            pt_ids = images[abs(img)].point3D_ids[valid]
-            if args.local_method == 'Colmap':
-                data_desc = descriptors_from_colmap_db(database_cursor, int(img))
-                #data_kpts = kpts_to_cv(data_kpts[valid[:data_kpts.shape[0]]] - 0.5)
-                data_desc = data_desc[valid[:data_desc.shape[0]]]
-            elif args.local_method in ['Superpoint', 'D2']:
-                if img > 0:
-                    path_to_img = 'data/AachenDayNight/images_upright/'+img_name
-                else:
-                    path_to_img = 'data/AachenDayNight/AugmentedNightImages_high_res/'+img_name.replace('db/', '').replace('.jpg', '.png')
-                    augments += 1
-                if desc_database is None:
-                    data_kpts = keypoints_from_colmap_db(database_cursor, abs(int(img)))
-                    data_kpts = data_kpts[valid[:data_kpts.shape[0]]] - 0.5
-                    if args.local_method == 'Superpoint':
-                        cv_img = cv2.imread(path_to_img, 0).astype(np.float32)/255.0
-                        _, data_desc, _ = model.run(cv_img, points=data_kpts)
-                        data_desc = data_desc.T
-                    elif args.local_method == 'D2':
-                        fixed_kpts = np.flip(data_kpts.copy(), axis=1)
-                        #print(fixed_kpts.shape)
-                        #print(fixed_kpts.max(axis=0))
-                        data_desc = model.get_features(path_to_img, fixed_kpts)
-                else:
-                    desc_database.execute('SELECT cols, desc FROM local_features WHERE image_id=?;', (abs(int(img)),))
-                    c, d = next(desc_database)
-                    data_desc = np.frombuffer(d, dtype=np.float32).reshape(c, -1)
+            if img not in seen:
+                seen.add(img)
+                if args.verify is not None and abs(img) == abs(query_image_ids[query_id]):
+                    continue
+                neighbors.append(img)
+    ## features of all neighbors with one select per query
+    if args.local_method == 'Colmap':
+        neighbor_features = database_features.descriptors_many([int(img) for img in neighbors])
+    elif desc_database is None:
+        neighbor_features = database_features.keypoints_many({abs(int(img)) for img in neighbors})
+    else:
+        neighbor_features = desc_database.get_many({abs(int(img)) for img in neighbors})
+    neighbor_descs = []
+    neighbor_pt_ids = []
+    for img in neighbors:
+        img_name = images[abs(img)].name
+        valid = images[abs(img)].valid
+        pt_ids = images[abs(img)].pt_ids
+        if args.local_method == 'Colmap':
+            data_desc = neighbor_features[int(img)]
+            #data_kpts = kpts_to_cv(data_kpts[valid[:data_kpts.shape[0]]] - 0.5)
+            data_desc = data_desc[valid[:data_desc.shape[0]]]
+        elif args.local_method in ['Superpoint', 'D2']:
+            if img > 0:
+                path_to_img = 'data/AachenDayNight/images_upright/'+img_name
+            else:
+                path_to_img = augmented_path(img_name)
+                augments += 1
+            if desc_database is None:
+                data_kpts = neighbor_features[abs(int(img))]
+                data_kpts = data_kpts[valid[:data_kpts.shape[0]]] - 0.5
+                if args.local_method == 'Superpoint':
+                    cv_img = cv2.imread(path_to_img, 0).astype(np.float32)/255.0
+                    _, data_desc, _ = model.run(cv_img, points=data_kpts)
+                    data_desc = data_desc.T
+                elif args.local_method == 'D2':
+                    fixed_kpts = np.flip(data_kpts.copy(), axis=1)
+                    #print(fixed_kpts.shape)
+                    #print(fixed_kpts.max(axis=0))
+                    data_desc = model.get_features(path_to_img, fixed_kpts)
+            else:
+                data_desc = neighbor_features[abs(int(img))]
+                
                     
-                        
-                #print('Query desc shape: {} \t Data desc shape: {}'.format(query_desc.shape, data_desc.shape))
-                ##database version
-                #superpoint_cursor.execute('SELECT cols, desc FROM local_features WHERE image_id==?;',(int(img),))
-                #cols, desc = next(superpoint_cursor)
-                #data_desc = np.frombuffer(desc, dtype=np.float32).reshape(cols, 256)
-            if 'approx' in mm:
-                data_desc = to_unit_vector(data_desc, method=mm, cuda=cuda)
-            if double:
-                matches = double_matching(matcher, query_desc, data_desc)
+            #print('Query desc shape: {} \t Data desc shape: {}'.format(query_desc.shape, data_desc.shape))
+            ##database version
+            #superpoint_cursor.execute('SELECT cols, desc FROM local_features WHERE image_id==?;',(int(img),))
+            #cols, desc = next(superpoint_cursor)
+            #data_desc = np.frombuffer(desc, dtype=np.float32).reshape(cols, 256)
+        neighbor_descs.append(data_desc)
+        neighbor_pt_ids.append(pt_ids)
+    ## normalize descriptors of all neighbors at once (single transfer to gpu)
+    if 'approx' in mm and len(neighbor_descs) > 0:
+        sizes = [d.shape[0] for d in neighbor_descs]
+        all_descs = to_unit_vector(np.concatenate(neighbor_descs), method=mm, cuda=cuda)
+        if type(all_descs) is torch.Tensor:
+            neighbor_descs = torch.split(all_descs, sizes)
+        else:
+            neighbor_descs = np.split(all_descs, np.cumsum(sizes)[:-1])
+    ## torch matchers compare the query with all neighbors in batched matrix products
+    if matcher.batched:
+        neighbor_matches = matcher.match_many_with_ratios(query_desc, neighbor_descs, double=double)
+    elif double:
+        neighbor_matches = [double_matching(matcher, query_desc, data_desc, with_ratios=True) for data_desc in neighbor_descs]
+    else:
+        neighbor_matches = [matcher.match_with_ratios(query_desc, data_desc) for data_desc in neighbor_descs]
+    for data_desc, pt_ids, (matches, ratios) in zip(neighbor_descs, neighbor_pt_ids, neighbor_matches):
+        #print('Found {} matches'.format(matches.shape[0]))
+        if matches.shape[0] > 0:
+            if refilter:
+                pt_ids_all.append(pt_ids[matches[:,1]])
+                data_descs.append(data_desc[torch.from_numpy(matches[:,1]).to(device)] if on_torch else data_desc[matches[:,1]])
             else:
-                matches = matcher.match(query_desc, data_desc)
-            #print('Found {} matches'.format(matches.shape[0]))
-            if type(data_desc) is torch.Tensor:
-                data_desc = data_desc.cpu().numpy()
-            if matches.shape[0] > 0:
-                if refilter:
-                    pt_ids_all.append(pt_ids[matches[:,1]])
-                    data_descs.append(data_desc[matches[:,1]])
-                else:
-                    matched_kpts_cv += [query_kpts[m[0]] for m in matches]
-                    matched_pts += [pt_ids[m[1]] for m in matches]
+                matched_kpt_idxs.append(matches[:,0])
+                matched_pts.append(pt_ids[matches[:,1]])
+                matched_ratios.append(ratios)
     if refilter:
         if len(pt_ids_all) < 1 or (len(data_descs) < 2):
             matches = np.array([])
         else:
             pt_ids_all = np.concatenate(pt_ids_all)
-            data_descs = np.vstack(data_descs)
-            if 'approx' in mm:
-                data_descs = to_unit_vector(data_descs, method=mm, cuda=cuda)
+            ## rows are already unit vectors for approx matching
+            data_descs = torch.cat(data_descs) if on_torch else np.vstack(data_descs)
             
             if double:
-                matches = double_matching(matcher, query_desc, data_descs)
+                matches, ratios = double_matching(matcher, query_desc, data_descs, with_ratios=True)
             else:
-                matches = matcher.match(query_desc, data_descs)
-            matched_kpts_cv = [query_kpts[m[0]] for m in matches]
-            matched_pts = [pt_ids_all[m[1]] for m in matches]
+                matches, ratios = matcher.match_with_ratios(query_desc, data_descs)
+            if matches.shape[0] > 0:
+                matched_kpt_idxs = [matches[:,0]]
+                matched_pts = [pt_ids_all[matches[:,1]]]
+                matched_ratios = [ratios]
                     
             if args.verify is not None and args.local_method == 'Colmap':
                 for m1, m2 in matches:
@@ -360,13 +735,16 @@ def match_local(args, mm, query_desc, query_kpts, images, points3d, query_id, cl
                         else:
                             incorrect += 1
     if len(matched_pts) > 0:
-        matched_pts_xyz = np.stack([points3d[i].xyz for i in matched_pts])
-        matched_keypoints = np.vstack([np.array([x.pt[0], x.pt[1]]) for x in matched_kpts_cv])
+        ## most distinctive matches first (lowest ratio test value), so PROSAC samples them first
+        order = np.argsort(np.concatenate(matched_ratios), kind='stable')
+        ## one gather per output, straight into the C-contiguous float64 (N,3) / (N,2) layout solvePnPRansac and poselib read
+        matched_pts_xyz = points.xyz.take(points.lut.take(np.concatenate(matched_pts).take(order)), axis=0)
+        matched_keypoints = np.asarray(query_kpts, dtype=np.float64).take(np.concatenate(matched_kpt_idxs).take(order), axis=0)
     else:
-        matched_pts_xyz = np.array([])
-        matched_keypoints = np.array([])
+        matched_pts_xyz = np.empty((0, 3))
+        matched_keypoints = np.empty((0, 2))
     if args.augmentation:
-        print_column_entry(' - Augmented images used', augments)
+        (log.entry if log is not None else print_column_entry)(' - Augmented images used', augments)
     return matched_pts_xyz, matched_keypoints, correct, incorrect
 
 
@@ -376,30 +754,123 @@ Output helpers
 """
 column_indents = [40, 1]
 seperating_char = '| '
+def column_entry(left_column, right_column, indents=column_indents, seperating_char=seperating_char):
+    return '\t{:{}} {:>{}}{}'.format(left_column, indents[0], seperating_char, indents[1], right_column)
+
 def print_column_entry(left_column, right_column, indents=column_indents, seperating_char=seperating_char):
-    print('\t{:{}} {:>{}}{}'.format(left_column, indents[0], seperating_char, indents[1], right_column))
+    print(column_entry(left_column, right_column, indents, seperating_char))
 
 sep_length = 100
 def print_seperator():
     print('-'*sep_length)
+
+"""
+Collects the output of one query and writes it in one go, also keeps the output of parallel workers apart
+"""
+class QueryLog:
+    def __init__(self):
+        self.lines = []
+
+    def entry(self, left_column, right_column, color=None):
+        line = column_entry(left_column, right_column)
+        self.lines.append(line if color is None else color + line + bcolors.ENDC)
+
+    def seperator(self):
+        self.lines.append('-'*sep_length)
+
+    def flush(self):
+        sys.stdout.write('\n'.join(self.lines) + '\n')
+        sys.stdout.flush()
+        self.lines = []
     
-def print_stats(li, lic, lii, errors, errors_rot, inlier_nums, inlier_rates, nbs, name):
-    if np.any(li):
+"""
+Mean, median, min, max and percentage results of all metric columns (C,N) under all masks (M,N) in one pass
+every statistic is a (M,C) array, empty masks give nan
+"""
+MaskedSummary = namedtuple('MaskedSummary', ['count', 'mean', 'median', 'min', 'max', 'percentage'])
+ERR, ROT, LMR, RATE, NUM, NBS = range(6)
+
+def masked_summary(metrics, masks):
+    metrics = np.asarray(metrics, dtype=np.float64)
+    masks = np.asarray(masks, dtype=bool)
+    count = masks.sum(axis=1)
+    empty = count == 0
+    sel = masks[:, None, :]
+    vals = metrics[None, :, :]
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.where(sel, vals, 0.0).sum(axis=2) / count[:, None]
+        median = np.nanmedian(np.where(sel, vals, np.nan), axis=2)
+        min_ = np.where(sel, vals, np.inf).min(axis=2)
+        max_ = np.where(sel, vals, -np.inf).max(axis=2)
+        min_[empty] = np.nan
+        max_[empty] = np.nan
+        t, q = metrics[ERR], metrics[ROT]
+        hits = np.stack([(t <= 0.25) & (q <= 2.0), (t <= 0.5) & (q <= 5.0), (t <= 5.0) & (q <= 10.0)])
+        percentage = masks.astype(np.int64).dot(hits.T.astype(np.int64)) / count[:, None].astype(np.float64) * 100.0
+    return MaskedSummary(count, mean, median, min_, max_, percentage)
+
+"""
+Classifies all verification results in one pass.
+A wrong result is blamed on the first matching reason: 0 bad neighbors, 1 few inliers (<12), 2 low inlier rate (<10%), 3 other.
+Returns the fine and wrong masks and the (4,N) masks of the reasons.
+"""
+def classify_results(errors, errors_rot, inlier_nums, inlier_rates, top_neighbor_max):
+    fine = (errors < 0.5) & (errors_rot < 2.0)
+    wrong = (errors > 5.0) | (errors_rot > 10.0)
+    reason = np.full(errors.shape[0], 3, dtype=np.int8)
+    reason[inlier_rates < 10] = 2
+    reason[inlier_nums < 12] = 1
+    reason[~(top_neighbor_max > 0.0)] = 0
+    return fine, wrong, reason == np.arange(4, dtype=np.int8)[:, None]
+
+"""
+Prints the summary of mask m, optionally also writes it with the given suffix to out_file
+"""
+def print_summary(summary, m, inlier_num_type, matching_rate=False, percentage=False, neighbors=False, out_file=None, suffix=''):
+    lines = [('Mean translational error', '{:.4f} m'.format(summary.mean[m, ERR])),
+             ('Median translational error', '{:.4f} m'.format(summary.median[m, ERR])),
+             ('Max translational error', '{:.4f} m'.format(summary.max[m, ERR])),
+             ('Mean angular error', '{:.4f} °'.format(summary.mean[m, ROT])),
+             ('Median angular error', '{:.4f} °'.format(summary.median[m, ROT])),
+             ('Max angular error', '{:.4f} °'.format(summary.max[m, ROT]))]
+    if matching_rate:
+        lines.append(('Average local matching rate', '{:.1f}%'.format(summary.mean[m, LMR])))
+    lines += [('Average inlier rate', '{:.1f}% / Total average: {}'.format(summary.mean[m, RATE], summary.mean[m, NUM])),
+              ('Min inlier rate', '{:.1f}% / Total min: {}'.format(summary.min[m, RATE], inlier_num_type(summary.min[m, NUM]))),
+              ('Max inlier rate', '{:.1f}% / Total max: {}'.format(summary.max[m, RATE], inlier_num_type(summary.max[m, NUM])))]
+    if percentage:
+        lines.append(('Percentage results', '{:.1f} / {:.1f} / {:.1f}'.format(*summary.percentage[m])))
+    if neighbors:
+        lines += [('Average correct neighbors', '{:.1f}'.format(summary.mean[m, NBS])),
+                  ('Min correct neighbors', '{:.1f}'.format(summary.min[m, NBS])),
+                  ('Max correct neighbors', '{:.1f}'.format(summary.max[m, NBS]))]
+    for left, right in lines:
+        print_column_entry(left, right)
+    if out_file is not None:
+        out_file.write(''.join('{}{}\t{}\n'.format(left, suffix, right) for left, right in lines))
+
+"""
+Prints total / correct / incorrect statistics of the masks li, lic and lii
+"""
+def print_stats(summary, li, lic, lii, name):
+    if summary.count[li] > 0:
+        s = summary
         print_seperator()
-        print_column_entry(name, '{} images'.format(np.sum(li)))
-        print_column_entry('Total / Correct / Incorrect', '{:d}\t / \t{:d}\t / \t{:d}'.format(np.sum(li), np.sum(lic), np.sum(lii)))
-        print_column_entry('Mean translational error', '{:.4f} m\t / \t{:.4f} m\t / \t{:.4f} m'.format(np.mean(errors[li]), np.mean(errors[lic]) if np.any(lic) else float('nan'), np.mean(errors[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Median translational error', '{:.4f} m\t / \t{:.4f} m\t / \t{:.4f} m'.format(np.median(errors[li]), np.median(errors[lic]) if np.any(lic) else float('nan'), np.median(errors[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Max translational error', '{:.4f} m\t / \t{:.4f} m\t / \t{:.4f} m'.format(np.max(errors[li]), np.max(errors[lic]) if np.any(lic) else float('nan'), np.max(errors[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Mean angular error', '{:.4f} °\t / \t{:.4f} °\t / \t{:.4f} °'.format(np.mean(errors_rot[li]), np.mean(errors_rot[lic]) if np.any(lic) else float('nan'), np.mean(errors_rot[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Median angular error', '{:.4f} °\t / \t{:.4f} °\t / \t{:.4f} °'.format(np.median(errors_rot[li]), np.median(errors_rot[lic]) if np.any(lic) else float('nan'), np.median(errors_rot[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Max angular error', '{:.4f} °\t / \t{:.4f} °\t / \t{:.4f} °'.format(np.max(errors_rot[li]), np.max(errors_rot[lic]) if np.any(lic) else float('nan'), np.max(errors_rot[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Average inlier rate', '({:.1f}% / {:.1f}) / ({:.1f}% / {:.1f}) / ({:.1f}% / {:.1f})'.format(np.mean(inlier_rates[li]), np.mean(inlier_nums[li]), np.mean(inlier_rates[lic]) if np.any(lic) else float('nan'), np.mean(inlier_nums[lic]) if np.any(lic) else float('nan'), np.mean(inlier_rates[lii]) if np.any(lii) else float('nan'), np.mean(inlier_nums[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Min inlier rate', '({:.1f}% / {:.0f}) / ({:.1f}% / {:.0f}) / ({:.1f}% / {:.0f})'.format(np.min(inlier_rates[li]), np.min(inlier_nums[li]), np.min(inlier_rates[lic]) if np.any(lic) else float('nan'), np.min(inlier_nums[lic]) if np.any(lic) else float('nan'), np.min(inlier_rates[lii]) if np.any(lii) else float('nan'), np.min(inlier_nums[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Max inlier rate', '({:.1f}% / {:.0f}) / ({:.1f}% / {:.0f}) / ({:.1f}% / {:.0f})'.format(np.max(inlier_rates[li]), np.max(inlier_nums[li]), np.max(inlier_rates[lic]) if np.any(lic) else float('nan'), np.max(inlier_nums[lic]) if np.any(lic) else float('nan'), np.max(inlier_rates[lii]) if np.any(lii) else float('nan'), np.max(inlier_nums[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Average correct neighbors', '{:.1f}\t / \t {:.1f}\t / \t {:.1f}'.format(np.mean(nbs[li]), np.mean(nbs[lic]) if np.any(lic) else float('nan'), np.mean(nbs[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Min correct neighbors', '{:.0f}\t / \t {:.0f}\t / \t {:.0f}'.format(np.min(nbs[li]), np.min(nbs[lic]) if np.any(lic) else float('nan'), np.min(nbs[lii]) if np.any(lii) else float('nan')))
-        print_column_entry('Max correct neighbors', '{:.0f}\t / \t {:.0f}\t / \t {:.0f}'.format(np.max(nbs[li]), np.max(nbs[lic]) if np.any(lic) else float('nan'), np.max(nbs[lii]) if np.any(lii) else float('nan')))
+        print_column_entry(name, '{} images'.format(s.count[li]))
+        print_column_entry('Total / Correct / Incorrect', '{:d}\t / \t{:d}\t / \t{:d}'.format(s.count[li], s.count[lic], s.count[lii]))
+        print_column_entry('Mean translational error', '{:.4f} m\t / \t{:.4f} m\t / \t{:.4f} m'.format(s.mean[li, ERR], s.mean[lic, ERR], s.mean[lii, ERR]))
+        print_column_entry('Median translational error', '{:.4f} m\t / \t{:.4f} m\t / \t{:.4f} m'.format(s.median[li, ERR], s.median[lic, ERR], s.median[lii, ERR]))
+        print_column_entry('Max translational error', '{:.4f} m\t / \t{:.4f} m\t / \t{:.4f} m'.format(s.max[li, ERR], s.max[lic, ERR], s.max[lii, ERR]))
+        print_column_entry('Mean angular error', '{:.4f} °\t / \t{:.4f} °\t / \t{:.4f} °'.format(s.mean[li, ROT], s.mean[lic, ROT], s.mean[lii, ROT]))
+        print_column_entry('Median angular error', '{:.4f} °\t / \t{:.4f} °\t / \t{:.4f} °'.format(s.median[li, ROT], s.median[lic, ROT], s.median[lii, ROT]))
+        print_column_entry('Max angular error', '{:.4f} °\t / \t{:.4f} °\t / \t{:.4f} °'.format(s.max[li, ROT], s.max[lic, ROT], s.max[lii, ROT]))
+        print_column_entry('Average inlier rate', '({:.1f}% / {:.1f}) / ({:.1f}% / {:.1f}) / ({:.1f}% / {:.1f})'.format(s.mean[li, RATE], s.mean[li, NUM], s.mean[lic, RATE], s.mean[lic, NUM], s.mean[lii, RATE], s.mean[lii, NUM]))
+        print_column_entry('Min inlier rate', '({:.1f}% / {:.0f}) / ({:.1f}% / {:.0f}) / ({:.1f}% / {:.0f})'.format(s.min[li, RATE], s.min[li, NUM], s.min[lic, RATE], s.min[lic, NUM], s.min[lii, RATE], s.min[lii, NUM]))
+        print_column_entry('Max inlier rate', '({:.1f}% / {:.0f}) / ({:.1f}% / {:.0f}) / ({:.1f}% / {:.0f})'.format(s.max[li, RATE], s.max[li, NUM], s.max[lic, RATE], s.max[lic, NUM], s.max[lii, RATE], s.max[lii, NUM]))
+        print_column_entry('Average correct neighbors', '{:.1f}\t / \t {:.1f}\t / \t {:.1f}'.format(s.mean[li, NBS], s.mean[lic, NBS], s.mean[lii, NBS]))
+        print_column_entry('Min correct neighbors', '{:.0f}\t / \t {:.0f}\t / \t {:.0f}'.format(s.min[li, NBS], s.min[lic, NBS], s.min[lii, NBS]))
+        print_column_entry('Max correct neighbors', '{:.0f}\t / \t {:.0f}\t / \t {:.0f}'.format(s.max[li, NBS], s.max[lic, NBS], s.max[lii, NBS]))
 
 
 """
@@ -411,41 +882,85 @@ def print_config(args):
     print_column_entry('Global method', args.global_method)
     if args.global_method == 'NetVLAD':
         print_column_entry('Global resolution', args.global_resolution)
+    print_column_entry('Global fp16 autocast', args.fp16)
     print_column_entry('Local method', args.local_method)
+    print_column_entry('Preload colmap features', args.preload_features)
+    print_column_entry('Feature cache size', args.feature_cache)
     if args.local_method in ['Superpoint', 'D2']:
         #print_column_entry(' - Database', args.superpoint_database)
         print_column_entry(' - Model', args.local_model_path)
+        print_column_entry(' - Query chunk', args.query_chunk)
     print_column_entry('Nearest neighbor method', args.nearest_method)
     if args.nearest_method == 'LSH':
         print_column_entry(' - hash buckets', 2**args.buckets)
     print_column_entry('k neighbors', args.n_neighbors)
     print_column_entry('Do clustering', args.cluster)
     print_column_entry('Local matching method', args.local_matching_method)
+    print_column_entry('Local matching fp16', args.fp16_matching)
+    print_column_entry('Local matching OpenCL', args.opencl)
     print_column_entry('Refilter', args.no_refilter)
     print_column_entry('Bidirectional filtering', args.bidirectional_filtering)
     print_column_entry('Matching threshold', args.ratio_thresh)
     print_column_entry('Num iterations RANSAC', args.n_iter)
     print_column_entry('Reprojection error', args.reproj_error)
     print_column_entry('Minimum num inliers PnP', args.min_inliers)
+    print_column_entry('PnP backend', args.pnp_backend)
+    if args.pnp_backend == 'opencv':
+        print_column_entry(' - PnP flags', args.pnp_flags)
+    print_column_entry('Query workers', '{} ({})'.format(args.workers, args.pool))
     print_column_entry('Use augmentation', args.augmentation)
     if args.augmentation and (args.local_method == 'Colmap' or args.global_method == 'NetVLAD'):
         raise NotImplementedError('Augmentation currently only works for Cirtorch/Superpoint')
 
+"""
+Checks argument combinations the installed libraries can not run, before anything is loaded
+"""
+def check_args(args):
+    if args.fp16 and not hasattr(torch.cuda, 'amp'):
+        parser.error('--fp16 requires torch.cuda.amp autocast (PyTorch >= 1.6), installed is {}'.format(torch.__version__))
+    if args.pnp_flags == 'prosac' and args.pnp_backend != 'opencv':
+        parser.error('--pnp_flags prosac is only available with --pnp_backend opencv')
+    if args.pnp_flags == 'prosac' and not hasattr(cv2, 'USAC_PROSAC'):
+        parser.error('--pnp_flags prosac requires OpenCV >= 4.5 (cv2.USAC_PROSAC), installed is {}'.format(cv2.__version__))
+
+
 
+"""
+OpenCL of OpenCV for --opencl, set once at startup and in every query worker (the setting is thread local in OpenCV)
+"""
+def init_opencl(args):
+    if args.opencl and cv2.ocl.haveOpenCL():
+        cv2.ocl.setUseOpenCL(True)
 
 """
 Loading data from storage into memory
 """
 def setup(args):
     print('Setup')
+    init_opencl(args)
     setup_time = time.time()
     t = time.time()
     images = get_images()
     points3d = get_points()
+    ## rotation matrices of all images at once, valid 3d point ids once per image
+    rotmats = qvecs2rotmats(np.stack([images[i].qvec for i in images]))
+    for i, R in zip(images, rotmats):
+        images[i].R = R
+        images[i].valid = images[i].point3D_ids > 0
+        images[i].pt_ids = images[i].point3D_ids[images[i].valid]
     t = time.time() - t
     print_column_entry('Read {} images and {} 3d points'.format(len(images), len(points3d)), time_to_str(t))
+    t = time.time()
+    points = get_point_arrays(points3d)
+    del points3d
+    t = time.time() - t
+    print_column_entry('3d point arrays', time_to_str(t))
     #get_img = lambda i: np.array(load_image('data/AachenDayNight/images_upright/'+images[i].name))
-    database_cursor = get_cursor(args.database_path)
+    t = time.time()
+    database_features = ColmapFeatures(get_cursor(args.database_path), preload=args.preload_features, cache_size=args.feature_cache)
+    t = time.time() - t
+    if args.preload_features:
+        print_column_entry('Preloaded colmap features of {} images'.format(len(database_features.desc)), time_to_str(t))
     if args.local_method == 'Colmap':
         query_cursor = get_cursor(args.colmap_query_database)
     else:
@@ -453,7 +968,7 @@ def setup(args):
     ##create image clusters
     if args.cluster:
         t = time.time()
-        img_cluster = get_img_cluster(images, points3d)
+        img_cluster = get_img_cluster(images, points)
         t = time.time() - t
         print_column_entry('Found {} cluster'.format(len(img_cluster)), time_to_str(t))
     else:
@@ -472,7 +987,7 @@ def setup(args):
             query_images += [os.path.join(args.dataset_dir, images[i].name) for i in images]
             query_image_ids += [i for i in images]
         if args.verify == 'all' or args.verify == 'night':
-            query_images += [os.path.join('data/AachenDayNight/AugmentedNightImages_high_res', images[i].name.replace('db/', '').replace('.jpg', '.png')) for i in images]
+            query_images += [augmented_path(images[i].name) for i in images]
             query_image_ids += [-i for i in images]
     else:
         query_images = get_files(args.dataset_dir, '*.jpg')
@@ -485,7 +1000,7 @@ def setup(args):
     print_column_entry('Found {} query images'.format(len(query_images)), time_to_str(t))
     print_column_entry('Total time', time_to_str(setup_time))
     
-    return points3d, images, database_cursor, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, setup_time
+    return points, images, database_features, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, setup_time
 
 
 """
@@ -506,13 +1021,16 @@ def global_neighbors(args, query_images):
             model = model.cuda()
         low_res_transform = transforms.Compose([transforms.Resize(224),#args.global_resolution),
                                                 transforms.CenterCrop(args.global_resolution), transforms.ToTensor() ])
-        for cnt, img in enumerate(query_images):
-            if cnt % (len(query_images)//5) == 0:
-                print_column_entry('', '{}/{} query descriptors'.format(cnt, len(query_images)))
-            if CUDA:
-                 query_global_desc.append(model(low_res_transform(load_image(img)).cuda().unsqueeze(0)).detach().cpu().squeeze(0).numpy())
-            else:
-                query_global_desc.append(model(low_res_transform(load_image(img)).unsqueeze(0)).detach().cpu().squeeze(0).numpy())
+        loader = torch.utils.data.DataLoader(
+            ImagesFromList(root='', images=query_images, transform=low_res_transform),
+            batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=CUDA)
+        with torch.no_grad(), (torch.cuda.amp.autocast() if args.fp16 and CUDA else contextlib.nullcontext()):
+            for cnt, batch in enumerate(loader):
+                if cnt % max(1, len(loader)//5) == 0:
+                    print_column_entry('', '{}/{} query descriptors'.format(cnt*args.batch_size, len(query_images)))
+                if CUDA:
+                    batch = batch.cuda(non_blocking=True)
+                query_global_desc.append(model(batch).float().cpu().numpy())
         query_global_desc = np.vstack(query_global_desc)
     elif args.global_method == 'Cirtorch':
         state = torch.load('data/teacher_models/retrievalSfM120k-resnet101-gem-b80fb85.pth')   
@@ -542,16 +1060,10 @@ def global_neighbors(args, query_images):
             net.cuda()
         net.eval()
         # set up the transform
-        normalize = transforms.Normalize(
-            mean=net.meta['mean'],
-            std=net.meta['std']
-        )
-        transform = transforms.Compose([
-            transforms.ToTensor(),
-            normalize
-        ])
+        ## ToTensor and Normalize in one op
+        transform = ToNormalizedTensor(mean=net.meta['mean'], std=net.meta['std'])
         Lw = None
-        query_global_desc = extract_vectors(net, query_images, 1024, transform, ms=ms, msp=msp)
+        query_global_desc = extract_vectors(net, query_images, 1024, transform, ms=ms, msp=msp, amp=args.fp16 and torch.cuda.is_available())
         query_global_desc = query_global_desc.numpy().T
     else:
         raise NotImplementedError('Global method not implemented')
@@ -562,12 +1074,12 @@ def global_neighbors(args, query_images):
     t = time.time()
     if args.global_method == 'NetVLAD':
         global_features_cursor = get_cursor(args.global_features_db)
-        global_features = []
+        n_features, feature_dim = next(global_features_cursor.execute('SELECT COUNT(*), MAX(cols) FROM global_features;'))
+        global_features = np.empty((n_features, feature_dim), dtype=np.float32)
         image_ids = []
-        for row in global_features_cursor.execute('SELECT image_id, cols, data FROM global_features;'):
-            global_features.append(np.frombuffer(row[2], dtype=np.float32).reshape(-1, row[1]))
+        for i, row in enumerate(global_features_cursor.execute('SELECT image_id, cols, data FROM global_features;')):
+            global_features[i] = np.frombuffer(row[2], dtype=np.float32)
             image_ids.append(row[0])
-        global_features = np.vstack(global_features)
         global_features_cursor.close()
     elif args.global_method == 'Cirtorch':
         global_features = np.load('data/cirtorch_data_descs.npy').T
@@ -576,6 +1088,9 @@ def global_neighbors(args, query_images):
             aug_features = np.load('data/cirtorch_augmented_descs.npy').T
             global_features = np.concatenate([global_features, aug_features])
             image_ids += [-images[i].id for i in images]
+    global_features = np.ascontiguousarray(global_features, dtype=np.float32)
+    image_ids = np.asarray(image_ids, dtype=np.int64)
+    query_global_desc = np.ascontiguousarray(query_global_desc, dtype=np.float32)
     t = time.time() - t
     print_column_entry('Database global features loaded', time_to_str(t))
 
@@ -587,28 +1102,20 @@ def global_neighbors(args, query_images):
     n_neighbors = args.n_neighbors
     if args.verify is not None:
         n_neighbors+= 2 if args.augmentation else 1
-    Matcher = GlobalMatcher(args.nearest_method, n_neighbors, False, args.buckets)
-    indices = Matcher.match(global_features, query_global_desc)
+    Matcher = GlobalMatcher(args.nearest_method, n_neighbors, False, args.buckets, use_gpu=torch.cuda.is_available())
+    indices = np.asarray(Matcher.match(global_features, query_global_desc), dtype=np.int64)
     """
     For verification pipeline the closest neighbor is always the query image itself.
     Hence we remove it to simulate real conditions.
     """
     if args.verify is not None:
-        indices_cut = []
-        for i in range(indices.shape[0]):
-            #indices_cut.append(indices[i,1:n_images+1])
-            lst = []
-            j = 0
-            img_itself = abs(image_ids[indices[i,0]])
-            for idx in indices[i,1:]:
-                if abs(image_ids[idx]) != img_itself:
-                    lst.append(idx)
-                    j += 1
-                if j >= args.n_neighbors:
-                    break
-            indices_cut.append(lst)
-            #print(len(lst))
-        indices = np.stack(indices_cut)
+        ## drop the query itself (and its augmentation), keep the first n_neighbors of the rest in order
+        neighbor_ids = np.abs(image_ids.take(indices))
+        keep = neighbor_ids != neighbor_ids[:,:1]
+        keep[:,0] = False
+        assert np.all(keep.sum(axis=1) >= args.n_neighbors), 'Not enough global neighbors besides the query itself'
+        order = np.argsort(~keep, axis=1, kind='stable')[:,:args.n_neighbors]
+        indices = np.take_along_axis(indices, order, axis=1)
     else:
         indices = indices[:,:n_neighbors]
     t = time.time() - t
@@ -620,203 +1127,352 @@ def global_neighbors(args, query_images):
 """
 Matches local features of query to cluster images and calculates 6dof pose
 """
-def local_matching(args, points3d, images, database_cursor, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, indices, image_ids, out_file):
-    ## Local features matching and pose retrieval
+"""
+PnP-RANSAC with poselib (optional dependency), including the final refinement on the inliers.
+Returns rotation matrix, translation and inlier indices.
+"""
+def solve_pnp_poselib(args, pts_xyz, kpts, camera_matrix, distortion_coeff, camera_size):
+    import poselib
+    camera = {'model': 'SIMPLE_RADIAL', 'width': int(camera_size[0]), 'height': int(camera_size[1]),
+              'params': [camera_matrix[0, 0], camera_matrix[0, 2], camera_matrix[1, 2], distortion_coeff]}
+    ransac_opt = {'max_reproj_error': args.reproj_error, 'max_iterations': args.n_iter}
+    ## match_local already returns contiguous float64 arrays, no conversion here
+    pose, info = poselib.estimate_absolute_pose(kpts, pts_xyz, camera, ransac_opt, {})
+    return pose.R, np.asarray(pose.t), np.flatnonzero(info['inliers'])
+
+"""
+Local matching state of the current process.
+Filled by init_local_matching, once in the main process or once per worker process.
+"""
+_local_state = {}
+QueryResult = namedtuple('QueryResult', ['time', 'top_neighbor_match', 'local_matching_rate', 'inlier_rate', 'inlier_num', 'error', 'error_rot', 'out_line'])
+def get_local_model(args):
     model = None
     if args.local_method == 'Superpoint':
         model = superpoint.SuperPointFrontend(weights_path=args.local_model_path,nms_dist=4, conf_thresh=0.015, nn_thresh=.7, cuda=torch.cuda.is_available())
     elif args.local_method == 'D2':
         model = d2net_interface(model_file=args.local_model_path, use_relu=False)
-    image_times = []
-    top_neighbor_match = []
-    local_matching_rate = []
-    inlier_rates, inlier_nums = [], []
-    errors = []
-    errors_rot = []
-    mm = 'OpenCV' if args.local_matching_method == 'exact' else ('approx_torch' if torch.cuda.is_available() else 'approx_numpy')
-    cuda = torch.cuda.is_available()
-    matcher = LocalMatcher(args.ratio_thresh, mm, True)
-    desc_database_cursor = get_cursor(args.desc_database) if args.desc_database is not None else None
-    print('Local feature matching and pose retrieval')
-    
-    backfall_cm = [camera_matrices[i]['cameraMatrix'] for i in camera_matrices]
-    backfall_cm = np.stack(backfall_cm)
-    backfall_cm = np.median(backfall_cm, axis=0)
-    
-    for query_id, query_name in enumerate(query_images):
+    return model
 
-        ## Make sure we have camera parameters.
-        if args.verify is not None:
-            query_path = images[abs(query_image_ids[query_id])].name
-        else:
-            query_path = os.path.join(*os.path.normpath(query_name).split(os.sep)[-4:])
-            
+"""
+Query images for local feature extraction, loaded in background workers.
+Superpoint gets grayscale float images in range [0,1], D2 the rgb images.
+"""
+class QueryImageDataset(torch.utils.data.Dataset):
+    def __init__(self, query_images, local_method):
+        self.query_images = query_images
+        self.local_method = local_method
 
-        individual_image_time = time.time()
-        print_column_entry('Processing query image {}/{}'.format(query_id+1, len(query_images)), 'Expected remaining time: {}'.format(time_to_str(np.mean(image_times)*(len(query_images)-query_id))) if query_id > 0 else '')
-        print_column_entry('Query path', query_name)
-        if args.verify is not None:
-            tn = []
-            for i, idx in enumerate(indices[query_id]):
-                global_match = calc_neighbor_match(abs(query_image_ids[query_id]), abs(image_ids[idx]), images)
-                tn.append(global_match)
-                #print_column_entry(' - Neighbor {} match'.format(i+1), '{:.1f}%'.format(global_match))
-            print_column_entry(' - # Neighbors with match > 0', '{}'.format(len([i for i in tn if i > 0.0])))
-            top_neighbor_match.append(tn)
-        t = time.time()
-        cluster_orig_ids = [image_ids[indices[query_id][0]]]
-        if args.cluster:
-            cluster_query = [img_cluster[i] for i in cluster_orig_ids]
-            for i, ind in enumerate(indices[query_id]):
-                ind = image_ids[ind]
-                if i == 0:
-                    continue
-                point_set = img_cluster[ind]
-                disjoint = False
-                for j, c in enumerate(cluster_query):
-                    if ind in c:
-                        cluster_query[j] |= point_set
-                        disjoint = True
-                        break
-                if not disjoint:
-                    cluster_orig_ids.append(ind)
-                    cluster_query.append(point_set)
-        else:
-            cluster_query = [[image_ids[indices[query_id][i]] for i in range(args.n_neighbors)]]
-        t = time.time() - t
-        #print_column_entry('Global neighbor ids', str(cluster_query))
-        print_column_entry(' - Clustered neighbors', time_to_str(t))
+    def __getitem__(self, index):
+        if self.local_method == 'Superpoint':
+            return index, cv2.imread(self.query_images[index], 0).astype(np.float32)/255.0
+        return index, imageio.imread(self.query_images[index])
 
+    def __len__(self):
+        return len(self.query_images)
 
-        ## Local features
-        t = time.time()
-        if args.local_method == 'Colmap':
-            ## query desc
-            test_query_path = query_name.replace(args.dataset_dir, '')
-            query_img_id = get_img_id(query_cursor, test_query_path)
-            query_kpts, query_desc = get_kpts_desc(query_cursor, query_img_id)
-            query_kpts = kpts_to_cv(query_kpts)
-        elif args.local_method == 'Superpoint':
-            cv_img = cv2.imread(query_name, 0).astype(np.float32)/255.0
-            kpts, query_desc, _ = model.run(cv_img)
-            query_desc = query_desc.T
-            query_kpts = kpts_to_cv(kpts.T)
+"""
+Keypoints and descriptors of the query images, generated per chunk of args.query_chunk consecutive queries
+as (query_ids, {query_id: (kpts, desc)}), so only the features of the chunk being matched are held in memory.
+Superpoint runs batched on equally sized images, D2 (single image pyramid) one image at a time.
+"""
+def extract_query_features(args, model, query_images):
+    query_features = {}
+    loader = torch.utils.data.DataLoader(QueryImageDataset(query_images, args.local_method), batch_size=1, shuffle=False,
+                                         num_workers=args.num_workers, pin_memory=torch.cuda.is_available())
+    chunk_start = 0
+    ## images of equal size waiting for a batch
+    buckets = {}
+    def run_superpoint(batch):
+        ids = [i for i, _ in batch]
+        results = model.run_batch(torch.stack([img for _, img in batch]))
+        for i, (kpts, desc, _) in zip(ids, results):
+            query_features[i] = (kpts[:2].T, desc.T)
+    for index, img in loader:
+        index, img = int(index[0]), img[0]
+        if args.local_method == 'Superpoint':
+            bucket = buckets.setdefault(tuple(img.shape), [])
+            bucket.append((index, img))
+            if len(bucket) == args.batch_size:
+                run_superpoint(bucket)
+                buckets[tuple(img.shape)] = []
         elif args.local_method == 'D2':
-            query_kpts, query_desc, _ =  model.extract_features(query_name, only_path=True)
+            query_kpts, query_desc, _ = model.extract_features(img.numpy(), only_path=False)
             #if 'ots' in args.local_model_path or 'no_photo' in args.local_model_path:
-            query_kpts = query_kpts[0]
-            query_desc = query_desc[0]
-            query_kpts = query_kpts[:,0:2]
-            query_kpts = kpts_to_cv(query_kpts)
+            query_features[index] = (query_kpts[0][:,0:2], query_desc[0])
         else:
             raise NotImplementedError('Local feature extraction method not implemented')
-        t = time.time() - t
-        print_column_entry(' - Got query keypoints and descriptors', time_to_str(t))
+        if index + 1 - chunk_start == args.query_chunk or index + 1 == len(query_images):
+            ## the chunk is complete once the images still waiting for a batch are processed
+            for bucket in buckets.values():
+                if len(bucket) > 0:
+                    run_superpoint(bucket)
+            buckets = {}
+            yield range(chunk_start, index + 1), query_features
+            query_features = {}
+            chunk_start = index + 1
 
+"""
+Query chunks of local matching: (query_ids, features) with the extracted features of the chunk,
+features is None for Colmap (read from the query database in process_one)
+"""
+def query_chunks(args, model, query_images):
+    if args.local_method in ['Superpoint', 'D2']:
+        return extract_query_features(args, model, query_images)
+    return iter([(range(len(query_images)), None)])
+
+def init_local_matching(args, points, images, database_features, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, indices, image_ids, model=None, prefetch=False):
+    if model is None:
+        model = get_local_model(args)
+    desc_database = None
+    if args.desc_database is not None:
+        desc_database = FeatureCache(functools.partial(local_descriptors_from_db, get_cursor(args.desc_database)), args.feature_cache)
+    if prefetch:
+        ## read features of global neighbors in bulk, in the order queries need them
+        ## (preloaded colmap features are served from memory and never read the cache)
+        neighbor_ids = image_ids.take(indices).ravel()
+        if args.local_method == 'Colmap':
+            if database_features.desc is None:
+                database_features.desc_cache.prefetch(neighbor_ids.tolist())
+        elif desc_database is None:
+            if database_features.kpts is None:
+                database_features.kpts_cache.prefetch(np.abs(neighbor_ids).tolist())
+        else:
+            desc_database.prefetch(np.abs(neighbor_ids).tolist())
+    if args.local_matching_method == 'exact':
+        mm = 'exact_torch' if torch.cuda.is_available() else 'OpenCV'
+    else:
+        mm = 'approx_torch' if torch.cuda.is_available() else 'approx_numpy'
+    _local_state.update(args=args, points=points, images=images, database_features=database_features, query_cursor=query_cursor,
+                        img_cluster=img_cluster, camera_matrices=camera_matrices, query_images=query_images, query_image_ids=query_image_ids,
+                        indices=indices, image_ids=image_ids, model=model, mm=mm, matcher=LocalMatcher(args.ratio_thresh, mm, True, fp16=args.fp16_matching, opencl=args.opencl),
+                        desc_database=desc_database, incidence=get_image_point_incidence(images) if args.verify is not None else None,
+                        query_cameras=get_query_cameras(args, query_images, query_image_ids, images, camera_matrices),
+                        groundtruth=get_groundtruth(images, query_image_ids) if args.verify is not None else None,
+                        colmap_query_names=[q.replace(args.dataset_dir, '') for q in query_images] if args.local_method == 'Colmap' else None)
 
-        ## Matching
-        t = time.time()
-        matched_pts_xyz, matched_keypoints, correct, incorrect = match_local(args, mm, query_desc, query_kpts, images, points3d, query_id, cluster_query, database_cursor, model, matcher, refilter=args.no_refilter, double=args.bidirectional_filtering, desc_database=desc_database_cursor)
-        t = time.time() - t
-        print_column_entry(' - Number of matched points', matched_keypoints.shape[0])
-        
-        #if len(matched_keypoints) < 5:
-        #    warnings.warn('Number of matched points too little. Lowering matching threshold recommended.')
-        #    continue
-        if args.verify is not None and args.local_method == 'Colmap':
-            sci = correct+incorrect
-            correct_prct = 100.0*(correct/float(sci)) if sci > 0 else 0.0
-            local_matching_rate.append(correct_prct)
-            print_column_entry(' - Correctly matched', '{:.1f}%'.format(correct_prct))
-        print_column_entry(' - Finished matching', time_to_str(t))
-        
+"""
+Initializer of worker processes. sqlite connections can not be shared between processes, so each worker opens its own.
+"""
+def _worker_init(args, points, images, database_features, img_cluster, camera_matrices, query_images, query_image_ids, indices, image_ids):
+    init_opencl(args)
+    database_features.cursor = get_cursor(args.database_path)
+    query_cursor = get_cursor(args.colmap_query_database) if args.local_method == 'Colmap' else None
+    init_local_matching(args, points, images, database_features, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, indices, image_ids)
 
+_thread_state = threading.local()
+"""
+Initializer of worker threads. Everything is shared except for the sqlite connections (and the caches reading from them).
+"""
+def _thread_init():
+    state = dict(_local_state)
+    args = state['args']
+    init_opencl(args)
+    state['database_features'] = state['database_features'].clone(get_cursor(args.database_path))
+    state['query_cursor'] = get_cursor(args.colmap_query_database) if args.local_method == 'Colmap' else None
+    if state['desc_database'] is not None:
+        state['desc_database'] = state['desc_database'].copy(functools.partial(local_descriptors_from_db, get_cursor(args.desc_database)))
+    _thread_state.state = state
 
-        ## Calculate pose
-        t = time.time()
-        if 'Augmented' in query_path:
-            query_path = query_path.replace('data/AachenDayNight/AugmentedNightImages_high_res/', 'db/').replace('.png', '.jpg')
-        if query_path not in camera_matrices:
-            print_column_entry('WARNING', '--CAMERA MATRIX UNKOWN -- USE BACKFALL --')
-            camera_matrix = backfall_cm
-        else:
-            cm = camera_matrices[query_path]
-            camera_matrix = cm['cameraMatrix']
-        distortion_coeff = cm['rad_dist']
-        dist_vec = np.array([distortion_coeff, 0, 0, 0])
-        
-        if matched_pts_xyz.shape[0] > 4:
-            success, R_vec, translation, inliers = cv2.solvePnPRansac(
-                matched_pts_xyz, matched_keypoints, camera_matrix, dist_vec,
-                iterationsCount=args.n_iter, reprojectionError=args.reproj_error,
-                flags=cv2.SOLVEPNP_P3P)
-        else:
-            inliers = None
-            success = False
+"""
+Local matching and pose calculation of a single query, query_feature are its (kpts, desc) for Superpoint and D2.
+The output line is returned instead of written so the output file stays in query order.
+"""
+def process_one(query_id, expected_remaining='', query_feature=None):
+    state = getattr(_thread_state, 'state', _local_state)
+    args, points, images, database_features, query_cursor = state['args'], state['points'], state['images'], state['database_features'], state['query_cursor']
+    img_cluster, camera_matrices, query_images, query_image_ids = state['img_cluster'], state['camera_matrices'], state['query_images'], state['query_image_ids']
+    indices, image_ids, model, mm, matcher = state['indices'], state['image_ids'], state['model'], state['mm'], state['matcher']
+    desc_database, query_cameras, groundtruth = state['desc_database'], state['query_cameras'], state['groundtruth']
+    query_name = query_images[query_id]
+    tn, correct_prct, error, error_rot, out_line = None, None, None, None, None
+    log = QueryLog()
+
+    individual_image_time = time.perf_counter()
+    log.entry('Processing query image {}/{}'.format(query_id+1, len(query_images)), expected_remaining)
+    log.entry('Query path', query_name)
+    neighbor_ids = image_ids.take(indices[query_id,:args.n_neighbors])
+    if args.verify is not None:
+        tn = calc_neighbor_matches(abs(query_image_ids[query_id]), np.abs(neighbor_ids), state['incidence']).tolist()
+        log.entry(' - # Neighbors with match > 0', '{}'.format(len([i for i in tn if i > 0.0])))
+    t = time.perf_counter()
+    if args.cluster:
+        cluster_orig_ids, cluster_query = cluster_neighbors(neighbor_ids.tolist(), img_cluster)
+    else:
+        cluster_query = [neighbor_ids.tolist()]
+    t = time.perf_counter() - t
+    #log.entry('Global neighbor ids', str(cluster_query))
+    log.entry(' - Clustered neighbors', time_to_str(t))
 
-        if inliers is not None:
-            inliers = inliers[:, 0] if len(inliers.shape) > 1 else inliers
-            num_inliers = len(inliers)
-            inlier_ratio = len(inliers) / len(matched_keypoints)
-        else:
-            num_inliers = 0
-            inlier_ratio = 0
-        inlier_rates.append(100.0*inlier_ratio)
-        inlier_nums.append(num_inliers)
-        print_column_entry(' - Inlier ratio', '{:.1f}%'.format(100.0*inlier_ratio))
-        print_column_entry(' - Inliers total', num_inliers)
-        success &= num_inliers >= args.min_inliers
-        #if inlier_ratio < 0.05:
-        #    warnings.warn('Very low inlier ratio')
 
-        if success:
+    ## Local features
+    t = time.perf_counter()
+    if args.local_method == 'Colmap':
+        ## query desc
+        query_img_id = get_img_id(query_cursor, state['colmap_query_names'][query_id])
+        query_kpts, query_desc = get_kpts_desc(query_cursor, query_img_id)
+    elif args.local_method in ['Superpoint', 'D2']:
+        ## extracted in advance by extract_query_features
+        query_kpts, query_desc = query_feature
+    else:
+        raise NotImplementedError('Local feature extraction method not implemented')
+    t = time.perf_counter() - t
+    log.entry(' - Got query keypoints and descriptors', time_to_str(t))
+
+
+    ## Matching
+    t = time.perf_counter()
+    matched_pts_xyz, matched_keypoints, correct, incorrect = match_local(args, mm, query_desc, query_kpts, images, points, query_id, query_image_ids, cluster_query, database_features, model, matcher, refilter=args.no_refilter, double=args.bidirectional_filtering, desc_database=desc_database, log=log)
+    t = time.perf_counter() - t
+    log.entry(' - Number of matched points', matched_keypoints.shape[0])
+    
+    #if len(matched_keypoints) < 5:
+    #    warnings.warn('Number of matched points too little. Lowering matching threshold recommended.')
+    #    continue
+    if args.verify is not None and args.local_method == 'Colmap':
+        sci = correct+incorrect
+        correct_prct = 100.0*(correct/float(sci)) if sci > 0 else 0.0
+        log.entry(' - Correctly matched', '{:.1f}%'.format(correct_prct))
+    log.entry(' - Finished matching', time_to_str(t))
+    
+
+
+    ## Calculate pose
+    t = time.perf_counter()
+    if not query_cameras.known[query_id]:
+        log.entry('WARNING', '--CAMERA MATRIX UNKOWN -- USE BACKFALL --')
+    camera_matrix = query_cameras.K[query_id]
+    distortion_coeff = query_cameras.rad_dist[query_id]
+    camera_size = query_cameras.size[query_id]
+    dist_vec = query_cameras.dist_vecs[query_id]
+    
+    if matched_pts_xyz.shape[0] > 4 and args.pnp_backend == 'poselib':
+        success = True
+        R_mat, translation, inliers = solve_pnp_poselib(args, matched_pts_xyz, matched_keypoints, camera_matrix, distortion_coeff, camera_size)
+    elif matched_pts_xyz.shape[0] > 4:
+        ## P3P by default, with --pnp_flags prosac the USAC PROSAC solver (OpenCV >= 4.5, checked in check_args)
+        ## which exploits that the matches are sorted by quality
+        success, R_vec, translation, inliers = cv2.solvePnPRansac(
+            matched_pts_xyz, matched_keypoints, camera_matrix, dist_vec,
+            iterationsCount=args.n_iter, reprojectionError=args.reproj_error,
+            flags=cv2.USAC_PROSAC if args.pnp_flags == 'prosac' else cv2.SOLVEPNP_P3P)
+    else:
+        inliers = None
+        success = False
+
+    if inliers is not None:
+        inliers = inliers[:, 0] if len(inliers.shape) > 1 else inliers
+        num_inliers = len(inliers)
+        inlier_ratio = len(inliers) / len(matched_keypoints)
+    else:
+        num_inliers = 0
+        inlier_ratio = 0
+    log.entry(' - Inlier ratio', '{:.1f}%'.format(100.0*inlier_ratio))
+    log.entry(' - Inliers total', num_inliers)
+    success &= num_inliers >= args.min_inliers
+    #if inlier_ratio < 0.05:
+    #    warnings.warn('Very low inlier ratio')
+
+    if success:
+        if args.pnp_backend == 'poselib':
+            ## poselib already refined the pose on all inliers
+            t = translation[:, None]
+        else:
             ret, R_vec, t = cv2.solvePnP(
                         matched_pts_xyz[inliers], matched_keypoints[inliers], camera_matrix,
                         dist_vec, rvec=R_vec, tvec=translation, useExtrinsicGuess=True,
                         flags=cv2.SOLVEPNP_ITERATIVE)
             success &= ret
+            R_mat = rvec_to_rotmat(R_vec)
 
-            query_T_w = np.eye(4)
-            query_T_w[:3, :3] = cv2.Rodrigues(R_vec)[0]
-            query_T_w[:3, 3] = t[:, 0]
-            w_T_query = np.linalg.inv(query_T_w)
-
-            name = os.path.split(query_name)[-1]
-            position = w_T_query[:3, 3]
-            quat = list(Quaternion(matrix=query_T_w)) # rotmat2qvec(w_T_query[:3,:3])
-            print_column_entry(' - Calculated position', position)
-        #else:
-            #if not success:
-            #    warnings.warn('Localization not successful!')
-        #    errors.append(1000)    ## can be chosen arbitrarily
-        #    errors_rot.append(180) ## same here
+        name = os.path.split(query_name)[-1]
+        position, quat = rotation_translation_to_pose_and_quat(R_mat, t[:, 0])
+        quat = list(quat)
+        log.entry(' - Calculated position', position)
+    #else:
+        #if not success:
+        #    warnings.warn('Localization not successful!')
 
-        if args.verify is not None:
-            gt = colmap_image_to_pose(images[abs(query_image_ids[query_id])])[:3,3]
-            rotation = images[abs(query_image_ids[query_id])].qvec
-            error_rot = quaternion_angular_error(rotation, quat)
+    if args.verify is not None:
+        gt = groundtruth.positions[query_id]
+        if success:
+            error_rot = quaternion_angular_error(groundtruth.qvecs[query_id], quat)
             error = np.linalg.norm(position-gt)
-            error_str = '%.1f m'%error if error > 1e-1 else '%.1f cm'%(100.0*error)
-            errors.append(error)
-            errors_rot.append(error_rot)
-            print_column_entry(' - Groundtruth', gt)
-            if error > 5.0 or error_rot > 10.0:
-                print(bcolors.FAIL, end='')
-            print_column_entry(' - Translation error', error_str)
-            print_column_entry(' - Angular error', '{:.2f}°'.format(error_rot))
-            if error > 5.0 or error_rot > 10.0:
-                print(bcolors.ENDC, end='')
-
-            #out_file.write('{} Error: {} CalcPos: {}\n'.format(name, error, position))
         else:
-            if success:
-                position = -txq.rotate_vector(np.array(position), np.array(quat))
-                out_file.write('{} {} {} {} {} {} {} {}\n'.format(name, quat[0], quat[1], quat[2], quat[3], position[0], position[1], position[2]))
+            error = 1000.0     ## can be chosen arbitrarily
+            error_rot = 180.0  ## same here
+        error_str = '%.1f m'%error if error > 1e-1 else '%.1f cm'%(100.0*error)
+        log.entry(' - Groundtruth', gt)
+        color = bcolors.FAIL if error > 5.0 or error_rot > 10.0 else None
+        log.entry(' - Translation error', error_str, color)
+        log.entry(' - Angular error', '{:.2f}°'.format(error_rot), color)
+
+        #out_file.write('{} Error: {} CalcPos: {}\n'.format(name, error, position))
+    else:
+        if success:
+            position = -txq.rotate_vector(np.array(position), np.array(quat))
+            out_line = '{} {} {} {} {} {} {} {}\n'.format(name, quat[0], quat[1], quat[2], quat[3], position[0], position[1], position[2])
 
-        individual_image_time = time.time() - individual_image_time 
-        print_column_entry('Finished image {}/{}'.format(query_id+1, len(query_images)), time_to_str(individual_image_time))
-        print_seperator()
-        image_times.append(individual_image_time)
+    individual_image_time = time.perf_counter() - individual_image_time 
+    log.entry('Finished image {}/{}'.format(query_id+1, len(query_images)), time_to_str(individual_image_time))
+    log.seperator()
+    log.flush()
+    return QueryResult(individual_image_time, tn, correct_prct, 100.0*inlier_ratio, num_inliers, error, error_rot, out_line)
+
+def local_matching(args, points, images, database_features, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, indices, image_ids, out_file):
+    ## Local features matching and pose retrieval
+    print('Local feature matching and pose retrieval')
+    results = []
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    model = get_local_model(args)
+    ## local features are extracted per query chunk, right before the chunk is matched
+    chunks = query_chunks(args, model, query_images)
+    if workers == 1:
+        init_local_matching(args, points, images, database_features, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, indices, image_ids, model, prefetch=True)
+        ## running sum of query times for the remaining time estimate
+        sum_time = 0.0
+        for query_ids, features in chunks:
+            for query_id in query_ids:
+                expected_remaining = 'Expected remaining time: {}'.format(time_to_str(sum_time/query_id*(len(query_images)-query_id))) if query_id > 0 else ''
+                results.append(process_one(query_id, expected_remaining, None if features is None else features.pop(query_id)))
+                sum_time += results[-1].time
+                if results[-1].out_line is not None:
+                    out_file.write(results[-1].out_line)
+    else:
+        ## queries are independent after global matching
+        if args.pool == 'thread':
+            ## opencv, numpy and torch release the gil, so threads sharing all data run in parallel as well
+            init_local_matching(args, points, images, database_features, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, indices, image_ids, model, prefetch=True)
+            executor = ThreadPoolExecutor(max_workers=workers, initializer=_thread_init)
+        else:
+            ## forked workers share the read only data, cuda can not be used in forked processes so spawned workers get a copy instead
+            ctx = multiprocessing.get_context('spawn' if torch.cuda.is_available() else 'fork')
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_worker_init,
+                                           initargs=(args, points, images, database_features, img_cluster, camera_matrices, query_images, query_image_ids, indices, image_ids))
+        with executor:
+            t = time.perf_counter()
+            def collect(futures):
+                for future in futures:
+                    result = future.result()
+                    results.append(result)
+                    if result.out_line is not None:
+                        out_file.write(result.out_line)
+                    t_elapsed = time.perf_counter() - t
+                    print_column_entry('Finished {}/{} queries'.format(len(results), len(query_images)), 'Expected remaining time: {}'.format(time_to_str(t_elapsed/len(results)*(len(query_images)-len(results)))))
+            ## every task only carries the features of its own query, the next chunk is extracted while the workers match the previous one
+            pending = []
+            for query_ids, features in chunks:
+                submitted = [executor.submit(process_one, query_id, '', None if features is None else features.pop(query_id)) for query_id in query_ids]
+                collect(pending)
+                pending = submitted
+            collect(pending)
+    image_times = [r.time for r in results]
+    top_neighbor_match = [r.top_neighbor_match for r in results if r.top_neighbor_match is not None]
+    local_matching_rate = [r.local_matching_rate for r in results if r.local_matching_rate is not None]
+    errors = [r.error for r in results if r.error is not None]
+    errors_rot = [r.error_rot for r in results if r.error_rot is not None]
+    inlier_rates = [r.inlier_rate for r in results]
+    inlier_nums = [r.inlier_num for r in results]
     return image_times, np.array(errors), np.array(errors_rot), np.array(top_neighbor_match), np.array(local_matching_rate), np.array(inlier_rates), np.array(inlier_nums)
 
 
@@ -832,149 +1488,59 @@ def stats(args, setup_time, image_times, errors, errors_rot, out_file, top_neigh
         out_file.write(str(args))
         out_file.write('\n')
         
+        ## all masks stacked into one table, every statistic below is looked up from it
+        fine, wrong, reasons = classify_results(errors, errors_rot, inlier_nums, inlier_rates, top_neighbor_match.max(axis=1))
+        ## bad neighbors, few inliers, low inlier rate, few inliers or low inlier rate, other
+        splits = np.concatenate([reasons[:3], reasons[1:2] | reasons[2:3], reasons[3:]])
+        masks = np.concatenate([np.stack([np.ones_like(wrong), ~reasons[0], fine, wrong, ~wrong]), splits, splits & wrong, splits & ~wrong])
+        names = ['all', 'good_nb', 'fine', 'wrong', 'not_wrong']
+        for suffix in ['', 'i', 'c']:
+            names += [name + suffix for name in ['bn', 'fi', 'li', 'fli', 'ot']]
+        row = {name: i for i, name in enumerate(names)}
+        nbs = np.sum(top_neighbor_match > 0.0, axis=1).astype(np.float64)
+        if len(local_matching_rate) != len(errors):
+            local_matching_rate = np.full(len(errors), np.nan)
+        summary = masked_summary([errors, errors_rot, local_matching_rate, inlier_rates, inlier_nums, nbs], masks)
+        inlier_num_type = np.asarray(inlier_nums).dtype.type
+        colmap = args.local_method == 'Colmap'
         
-        print_column_entry('Mean translational error', '{:.4f} m'.format(np.mean(errors)))
-        print_column_entry('Median translational error', '{:.4f} m'.format(np.median(errors)))
-        print_column_entry('Max translational error', '{:.4f} m'.format(np.max(errors)))
-        print_column_entry('Mean angular error', '{:.4f} °'.format(np.mean(errors_rot)))
-        print_column_entry('Median angular error', '{:.4f} °'.format(np.median(errors_rot)))
-        print_column_entry('Max angular error', '{:.4f} °'.format(np.max(errors_rot)))
-        if args.local_method == 'Colmap':
-            print_column_entry('Average local matching rate', '{:.1f}%'.format(np.mean(local_matching_rate)))
-        print_column_entry('Average inlier rate', '{:.1f}% / Total average: {}'.format(np.mean(inlier_rates), np.mean(inlier_nums)))
-        print_column_entry('Min inlier rate', '{:.1f}% / Total min: {}'.format(np.min(inlier_rates), np.min(inlier_nums)))
-        print_column_entry('Max inlier rate', '{:.1f}% / Total max: {}'.format(np.max(inlier_rates), np.max(inlier_nums)))
-        print_column_entry('Percentage results', '{:.1f} / {:.1f} / {:.1f}'.format(*percentage_stats(errors, errors_rot)))
-        
-
-        out_file.write('Mean translational error\t{:.4f} m\n'.format(np.mean(errors)))
-        out_file.write('Median translational error\t{:.4f} m\n'.format(np.median(errors)))
-        out_file.write('Max translational error\t{:.4f} m\n'.format(np.max(errors)))
-        out_file.write('Mean angular error\t{:.4f} °\n'.format(np.mean(errors_rot)))
-        out_file.write('Median angular error\t{:.4f} °\n'.format(np.median(errors_rot)))
-        out_file.write('Max angular error\t{:.4f} °\n'.format(np.max(errors_rot)))
-        if args.local_method == 'Colmap':
-            out_file.write('Average local matching rate\t{:.1f}%\n'.format(np.mean(local_matching_rate)))
-        out_file.write('Average inlier rate\t{:.1f}% / Total average: {}\n'.format(np.mean(inlier_rates), np.mean(inlier_nums)))
-        out_file.write('Min inlier rate\t{:.1f}% / Total min: {}\n'.format(np.min(inlier_rates), np.min(inlier_nums)))
-        out_file.write('Max inlier rate\t{:.1f}% / Total max: {}\n'.format(np.max(inlier_rates), np.max(inlier_nums)))
-        out_file.write('Percentage results\t{:.1f} / {:.1f} / {:.1f}\n'.format(*percentage_stats(errors, errors_rot)))
+        print_summary(summary, row['all'], inlier_num_type, matching_rate=colmap, percentage=True, out_file=out_file)
         
         if top_neighbor_match.max(axis=1).shape[0] > 0:
-            valid = top_neighbor_match.max(axis=1) > 0.0
             print_seperator()
-            if np.any(valid):
-                print_column_entry('Filtered by good neighbors', '{} images'.format(errors[valid].shape[0]))
-                print_column_entry('Mean translational error', '{:.4f} m'.format(np.mean(errors[valid])))
-                print_column_entry('Median translational error', '{:.4f} m'.format(np.median(errors[valid])))
-                print_column_entry('Max translational error', '{:.4f} m'.format(np.max(errors[valid])))
-                print_column_entry('Mean angular error', '{:.4f} °'.format(np.mean(errors_rot[valid])))
-                print_column_entry('Median angular error', '{:.4f} °'.format(np.median(errors_rot[valid])))
-                print_column_entry('Max angular error', '{:.4f} °'.format(np.max(errors_rot[valid])))
-                if args.local_method == 'Colmap':
-                    print_column_entry('Average local matching rate', '{:.1f}%'.format(np.mean(local_matching_rate[valid])))
-                print_column_entry('Average inlier rate', '{:.1f}% / Total average: {}'.format(np.mean(inlier_rates[valid]), np.mean(inlier_nums[valid])))
-                print_column_entry('Min inlier rate', '{:.1f}% / Total min: {}'.format(np.min(inlier_rates[valid]), np.min(inlier_nums[valid])))
-                print_column_entry('Max inlier rate', '{:.1f}% / Total max: {}'.format(np.max(inlier_rates[valid]), np.max(inlier_nums[valid])))
-                print_column_entry('Percentage results', '{:.1f} / {:.1f} / {:.1f}'.format(*percentage_stats(errors[valid], errors_rot[valid])))
-                out_file.write('Mean translational error good neighbors filtered\t{:.4f} m\n'.format(np.mean(errors[valid])))
-                out_file.write('Median translational error good neighbors filtered\t{:.4f} m\n'.format(np.median(errors[valid])))
-                out_file.write('Max translational error good neighbors filtered\t{:.4f} m\n'.format(np.max(errors[valid])))
-                out_file.write('Mean angular error good neighbors filtered\t{:.4f} °\n'.format(np.mean(errors_rot[valid])))
-                out_file.write('Median angular error good neighbors filtered\t{:.4f} °\n'.format(np.median(errors_rot[valid])))
-                out_file.write('Max angular error good neighbors filtered\t{:.4f} °\n'.format(np.max(errors_rot[valid])))
-                if args.local_method == 'Colmap':
-                    out_file.write('Average local matching rate good neighbors filtered\t{:.1f}%\n'.format(np.mean(local_matching_rate[valid])))
-                out_file.write('Average inlier rate good neighbors filtered\t{:.1f}% / Total average: {}\n'.format(np.mean(inlier_rates[valid]), np.mean(inlier_nums[valid])))
-                out_file.write('Min inlier rate good neighbors filtered\t{:.1f}% / Total min: {}\n'.format(np.min(inlier_rates[valid]), np.min(inlier_nums[valid])))
-                out_file.write('Max inlier rate good neighbors filtered\t{:.1f}% / Total max: {}\n'.format(np.max(inlier_rates[valid]), np.max(inlier_nums[valid])))
-                out_file.write('Percentage results good neighbors filtered\t{:.1f} / {:.1f} / {:.1f}\n'.format(*percentage_stats(errors[valid], errors_rot[valid])))
+            if summary.count[row['good_nb']] > 0:
+                print_column_entry('Filtered by good neighbors', '{} images'.format(summary.count[row['good_nb']]))
+                print_summary(summary, row['good_nb'], inlier_num_type, matching_rate=colmap, percentage=True, out_file=out_file, suffix=' good neighbors filtered')
             else:
                 print_column_entry('No images found (good neighbors)', '')
             print_seperator()
-            if np.any(~valid):
-                print_column_entry('Filtered by bad neighbors', '{} images'.format(errors[~valid].shape[0]))
-                print_column_entry('Mean translational error', '{:.4f} m'.format(np.mean(errors[~valid])))
-                print_column_entry('Median translational error', '{:.4f} m'.format(np.median(errors[~valid])))
-                print_column_entry('Max translational error', '{:.4f} m'.format(np.max(errors[~valid])))
-                print_column_entry('Mean angular error', '{:.4f} °'.format(np.mean(errors_rot[~valid])))
-                print_column_entry('Median angular error', '{:.4f} °'.format(np.median(errors_rot[~valid])))
-                print_column_entry('Max angular error', '{:.4f} °'.format(np.max(errors_rot[~valid])))
-                if args.local_method == 'Colmap':
-                    print_column_entry('Average local matching rate', '{:.1f}%'.format(np.mean(local_matching_rate[~valid])))
-                print_column_entry('Average inlier rate', '{:.1f}% / Total average: {}'.format(np.mean(inlier_rates[~valid]), np.mean(inlier_nums[~valid])))
-                print_column_entry('Min inlier rate', '{:.1f}% / Total min: {}'.format(np.min(inlier_rates[~valid]), np.min(inlier_nums[~valid])))
-                print_column_entry('Max inlier rate', '{:.1f}% / Total max: {}'.format(np.max(inlier_rates[~valid]), np.max(inlier_nums[~valid])))
-                print_column_entry('Percentage results', '{:.1f} / {:.1f} / {:.1f}'.format(*percentage_stats(errors[~valid], errors_rot[~valid])))
-                out_file.write('Mean translational error bad neighbors filtered\t{:.4f} m\n'.format(np.mean(errors[~valid])))
-                out_file.write('Median translational error bad neighbors filtered\t{:.4f} m\n'.format(np.median(errors[~valid])))
-                out_file.write('Max translational error bad neighbors filtered\t{:.4f} m\n'.format(np.max(errors[~valid])))
-                out_file.write('Mean angular error bad neighbors filtered\t{:.4f} °\n'.format(np.mean(errors_rot[~valid])))
-                out_file.write('Median angular error bad neighbors filtered\t{:.4f} °\n'.format(np.median(errors_rot[~valid])))
-                out_file.write('Max angular error bad neighbors filtered\t{:.4f} °\n'.format(np.max(errors_rot[~valid])))
-                if args.local_method == 'Colmap':
-                    out_file.write('Average local matching rate bad neighbors filtered\t{:.1f}%\n'.format(np.mean(local_matching_rate[~valid])))
-                out_file.write('Average inlier rate bad neighbors filtered\t{:.1f}% / Total average: {}\n'.format(np.mean(inlier_rates[~valid]), np.mean(inlier_nums[~valid])))
-                out_file.write('Min inlier rate bad neighbors filtered\t{:.1f}% / Total min: {}\n'.format(np.min(inlier_rates[~valid]), np.min(inlier_nums[~valid])))
-                out_file.write('Max inlier rate bad neighbors filtered\t{:.1f}% / Total max: {}\n'.format(np.max(inlier_rates[~valid]), np.max(inlier_nums[~valid])))
-                out_file.write('Percentage results bad neighbors filtered\t{:.1f} / {:.1f} / {:.1f}\n'.format(*percentage_stats(errors[~valid], errors_rot[~valid])))
+            if summary.count[row['bn']] > 0:
+                print_column_entry('Filtered by bad neighbors', '{} images'.format(summary.count[row['bn']]))
+                print_summary(summary, row['bn'], inlier_num_type, matching_rate=colmap, percentage=True, out_file=out_file, suffix=' bad neighbors filtered')
             else:
                 print_column_entry('No images found (bad neighbors)', '')
 
             
         print_seperator()
-        valid = np.logical_and(errors < 0.5, errors_rot < 2.0)
-        nbs = np.zeros_like(top_neighbor_match)
-        nbs[top_neighbor_match > 0.0] = 1.0
-        nbs = np.sum(nbs, axis=1)
-        if np.any(valid):
-            print_column_entry('Filtered by fine localized results', '{} images'.format(errors[valid].shape[0]))
-            print_column_entry('Mean translational error', '{:.4f} m'.format(np.mean(errors[valid])))
-            print_column_entry('Median translational error', '{:.4f} m'.format(np.median(errors[valid])))
-            print_column_entry('Max translational error', '{:.4f} m'.format(np.max(errors[valid])))
-            print_column_entry('Mean angular error', '{:.4f} °'.format(np.mean(errors_rot[valid])))
-            print_column_entry('Median angular error', '{:.4f} °'.format(np.median(errors_rot[valid])))
-            print_column_entry('Max angular error', '{:.4f} °'.format(np.max(errors_rot[valid])))
-            if args.local_method == 'Colmap':
-                print_column_entry('Average local matching rate', '{:.1f}%'.format(np.mean(local_matching_rate[valid])))
-            print_column_entry('Average inlier rate', '{:.1f}% / Total average: {}'.format(np.mean(inlier_rates[valid]), np.mean(inlier_nums[valid])))
-            print_column_entry('Min inlier rate', '{:.1f}% / Total min: {}'.format(np.min(inlier_rates[valid]), np.min(inlier_nums[valid])))
-            print_column_entry('Max inlier rate', '{:.1f}% / Total max: {}'.format(np.max(inlier_rates[valid]), np.max(inlier_nums[valid])))
-            print_column_entry('Average correct neighbors', '{:.1f}'.format(np.mean(nbs[valid])))
-            print_column_entry('Min correct neighbors', '{:.1f}'.format(np.min(nbs[valid])))
-            print_column_entry('Max correct neighbors', '{:.1f}'.format(np.max(nbs[valid])))
+        if summary.count[row['fine']] > 0:
+            print_column_entry('Filtered by fine localized results', '{} images'.format(summary.count[row['fine']]))
+            print_summary(summary, row['fine'], inlier_num_type, matching_rate=colmap, neighbors=True)
         else:
             print_column_entry('No images found (fine localized)', '')
             
         print_seperator()
-        valid = np.logical_or(errors > 5.0, errors_rot > 10.0)
-        if np.any(valid):
-            print_column_entry('Filtered by wrongly localized results', '{} images'.format(np.sum(valid)))
-            print_column_entry('Mean translational error', '{:.4f} m'.format(np.mean(errors[valid])))
-            print_column_entry('Median translational error', '{:.4f} m'.format(np.median(errors[valid])))
-            print_column_entry('Max translational error', '{:.4f} m'.format(np.max(errors[valid])))
-            print_column_entry('Mean angular error', '{:.4f} °'.format(np.mean(errors_rot[valid])))
-            print_column_entry('Median angular error', '{:.4f} °'.format(np.median(errors_rot[valid])))
-            print_column_entry('Max angular error', '{:.4f} °'.format(np.max(errors_rot[valid])))
-            if args.local_method == 'Colmap':
-                print_column_entry('Average local matching rate', '{:.1f}%'.format(np.mean(local_matching_rate[valid])))
-            print_column_entry('Average inlier rate', '{:.1f}% / Total average: {}'.format(np.mean(inlier_rates[valid]), np.mean(inlier_nums[valid])))
-            print_column_entry('Min inlier rate', '{:.1f}% / Total min: {}'.format(np.min(inlier_rates[valid]), np.min(inlier_nums[valid])))
-            print_column_entry('Max inlier rate', '{:.1f}% / Total max: {}'.format(np.max(inlier_rates[valid]), np.max(inlier_nums[valid])))
-            print_column_entry('Average correct neighbors', '{:.1f}'.format(np.mean(nbs[valid])))
-            print_column_entry('Min correct neighbors', '{:.1f}'.format(np.min(nbs[valid])))
-            print_column_entry('Max correct neighbors', '{:.1f}'.format(np.max(nbs[valid])))
+        if summary.count[row['wrong']] > 0:
+            print_column_entry('Filtered by wrongly localized results', '{} images'.format(summary.count[row['wrong']]))
+            print_summary(summary, row['wrong'], inlier_num_type, matching_rate=colmap, neighbors=True)
             
             print_seperator()
-            print_column_entry('Identifying reasons', '{} total'.format(np.sum(valid)))
+            print_column_entry('Identifying reasons', '{} total'.format(summary.count[row['wrong']]))
             out_file.write('Wrongly localized images: \n')
             ## bad neighbors
-            bn = ~(top_neighbor_match.max(axis=1) > 0.0)
-            bni = np.logical_and(bn, valid)
-            bnc = np.logical_and(bn, ~valid)
-            print_column_entry(' - by wrong neighbors', np.sum(bni))
+            bni = masks[row['bni']]
+            print_column_entry(' - by wrong neighbors', summary.count[row['bni']])
             out_file.write(' - by wrong global neighbors:')
-            if np.sum(bn) > 0:
+            if summary.count[row['bn']] > 0:
                 for img in np.array(query_images)[bni]:
                     out_file.write(' {},'.format(os.path.split(img)[-1].replace('.jpg', '')))
                 out_file.write('\n')
@@ -982,12 +1548,10 @@ def stats(args, setup_time, image_times, errors, errors_rot, out_file, top_neigh
                 out_file.write(' None\n')
             ## few inliers
             out_file.write(' - by few inliers:')
-            fi = np.logical_and(inlier_nums < 12, ~bn) #few inliers
-            fii = np.logical_and(fi, valid)            #few inliers incorrect
-            fic = np.logical_and(fi, ~valid)           #few inliers correct
-            print_column_entry(' - by few inliers (<12)', np.sum(fii))
-            assert np.sum(fii)+np.sum(fic) == np.sum(fi), 'Somethings wrong I can feel it..'
-            if np.sum(fii) > 0:
+            fii = masks[row['fii']]            #few inliers incorrect
+            print_column_entry(' - by few inliers (<12)', summary.count[row['fii']])
+            assert summary.count[row['fii']]+summary.count[row['fic']] == summary.count[row['fi']], 'Somethings wrong I can feel it..'
+            if summary.count[row['fii']] > 0:
                 for img in np.array(query_images)[fii]:
                     out_file.write(' {},'.format(os.path.split(img)[-1].replace('.jpg', '')))
                 out_file.write('\n')
@@ -995,12 +1559,10 @@ def stats(args, setup_time, image_times, errors, errors_rot, out_file, top_neigh
                 out_file.write(' None\n')
             ## low inlier rate
             out_file.write(' - by low inlier rate:')
-            li = np.logical_and(inlier_rates < 10, np.logical_and(~fi, ~bn))
-            lii = np.logical_and(li, valid)
-            lic = np.logical_and(li, ~valid)
-            assert np.sum(lii)+np.sum(lic) == np.sum(li), 'Somethings wrong I can feel it..'
-            print_column_entry(' - by low inlier rate (<10%)', np.sum(lii))
-            if np.sum(lii) > 0:
+            lii = masks[row['lii']]
+            assert summary.count[row['lii']]+summary.count[row['lic']] == summary.count[row['li']], 'Somethings wrong I can feel it..'
+            print_column_entry(' - by low inlier rate (<10%)', summary.count[row['lii']])
+            if summary.count[row['lii']] > 0:
                 for img in np.array(query_images)[lii]:
                     out_file.write(' {},'.format(os.path.split(img)[-1].replace('.jpg', '')))
                 out_file.write('\n')
@@ -1008,26 +1570,21 @@ def stats(args, setup_time, image_times, errors, errors_rot, out_file, top_neigh
                 out_file.write(' None\n')
             ## other
             out_file.write(' - other:')
-            ot = np.logical_and(np.logical_and(~li, ~fi), ~bn)
-            oti = np.logical_and(ot, valid)
-            otc = np.logical_and(ot, ~valid)
-            assert np.sum(oti)+np.sum(otc) == np.sum(ot), 'Somethings wrong I can feel it..'
-            print_column_entry(' - other', np.sum(oti))
-            if np.sum(oti) > 0:
+            oti = masks[row['oti']]
+            assert summary.count[row['oti']]+summary.count[row['otc']] == summary.count[row['ot']], 'Somethings wrong I can feel it..'
+            print_column_entry(' - other', summary.count[row['oti']])
+            if summary.count[row['oti']] > 0:
                 for img in np.array(query_images)[oti]:
                     out_file.write(' {}, '.format(''.join(list(filter(str.isdigit, os.path.split(img)[-1])))))
                 out_file.write('\n')
             else:
                 out_file.write(' None\n')
-            print_stats(np.ones_like(errors, dtype=bool), ~valid, valid, errors, errors_rot, inlier_nums, inlier_rates, nbs, 'Not correctly localised')
-            print_stats(bn, bnc, bni, errors, errors_rot, inlier_nums, inlier_rates, nbs, 'Bad neighbours')
-            print_stats(fi, fic, fii, errors, errors_rot, inlier_nums, inlier_rates, nbs, 'Few inliers')
-            print_stats(li, lic, lii, errors, errors_rot, inlier_nums, inlier_rates, nbs, 'Low inlier rate')
-            fli = np.logical_or(fi, li)
-            flii = np.logical_and(fli, valid)
-            flic = np.logical_and(fli, ~valid)
-            print_stats(fli, flic, flii, errors, errors_rot, inlier_nums, inlier_rates, nbs, 'Few inliers or low inlier rate')
-            print_stats(ot, otc, oti, errors, errors_rot, inlier_nums, inlier_rates, nbs, 'Other cases')
+            print_stats(summary, row['all'], row['not_wrong'], row['wrong'], 'Not correctly localised')
+            print_stats(summary, row['bn'], row['bnc'], row['bni'], 'Bad neighbours')
+            print_stats(summary, row['fi'], row['fic'], row['fii'], 'Few inliers')
+            print_stats(summary, row['li'], row['lic'], row['lii'], 'Low inlier rate')
+            print_stats(summary, row['fli'], row['flic'], row['flii'], 'Few inliers or low inlier rate')
+            print_stats(summary, row['ot'], row['otc'], row['oti'], 'Other cases')
             
             
         else:
@@ -1039,11 +1596,12 @@ def stats(args, setup_time, image_times, errors, errors_rot, out_file, top_neigh
         
 if __name__ == '__main__':
     args = parser.parse_args()
+    check_args(args)
     print_config(args)
-    points3d, images, database_cursor, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, setup_time = setup(args)
+    points, images, database_features, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, setup_time = setup(args)
     indices, image_ids = global_neighbors(args, query_images)
     out_file = open(args.out_file, 'w', buffering=1)
-    image_times, errors, errors_rot, top_neighbor_match, local_matching_rate, inlier_rates, inlier_nums = local_matching(args, points3d, images, database_cursor, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, indices, image_ids, out_file)   
+    image_times, errors, errors_rot, top_neighbor_match, local_matching_rate, inlier_rates, inlier_nums = local_matching(args, points, images, database_features, query_cursor, img_cluster, camera_matrices, query_images, query_image_ids, indices, image_ids, out_file)   
     stats(args, setup_time, image_times, errors, errors_rot, out_file, top_neighbor_match, local_matching_rate, inlier_rates, inlier_nums)
     out_file.close()
     
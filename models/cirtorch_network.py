@@ -1,4 +1,5 @@
 import os
+import contextlib
 #import pdb
 
 import torch
@@ -9,7 +10,7 @@ import torchvision
 
 from models.cirtorch_utils.pooling import MAC, SPoC, GeM, GeMmp, RMAC, Rpool
 from models.cirtorch_utils.normalization import L2N, PowerLaw
-from models.cirtorch_utils.genericdataset import ImagesFromList
+from models.cirtorch_utils.imagedataset import ImagesFromList
 #from cirtorch.utils.general import get_data_root
 
 # for some models, we have imported features (convolutions) from caffe because the image retrieval performance is higher for them
@@ -275,7 +276,7 @@ def init_network(params):
     return net
 
 
-def extract_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1, print_freq=10):
+def extract_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1, print_freq=10, amp=False):
     # moving network to gpu and eval mode
     net.cuda()
     net.eval()
@@ -286,8 +287,8 @@ def extract_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1
         batch_size=1, shuffle=False, num_workers=8, pin_memory=True
     )
 
-    # extracting vectors
-    with torch.no_grad():
+    # extracting vectors (optionally in fp16, batchnorm statistics are fixed by eval mode)
+    with torch.no_grad(), (torch.cuda.amp.autocast() if amp else contextlib.nullcontext()):
         vecs = torch.zeros(net.meta['outputdim'], len(images))
         for i, input in enumerate(loader):
             input = input.cuda()
@@ -1,4 +1,5 @@
 import os
+import numpy as np
 from PIL import Image
 
 import torch
@@ -18,10 +19,13 @@ def cid2filename(cid, prefix):
     """
     return os.path.join(prefix, cid[-2:], cid[-4:-2], cid[-6:-4], cid)
 
-def pil_loader(path):
+def pil_loader(path, imsize=None):
     # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
     with open(path, 'rb') as f:
         img = Image.open(f)
+        if imsize is not None:
+            # jpeg only: decode at the smallest 1/2, 1/4 or 1/8 scale that still keeps both sides >= imsize
+            img.draft('RGB', (imsize, imsize))
         return img.convert('RGB')
 
 def accimage_loader(path):
@@ -32,17 +36,43 @@ def accimage_loader(path):
         # Potentially a decoding problem, fall back to PIL.Image
         return pil_loader(path)
 
-def default_loader(path):
+def default_loader(path, imsize=None):
     from torchvision import get_image_backend
     if get_image_backend() == 'accimage':
         return accimage_loader(path)
     else:
-        return pil_loader(path)
+        return pil_loader(path, imsize)
 
 def imresize(img, imsize):
     img.thumbnail((imsize, imsize), Image.ANTIALIAS)
     return img
 
+class ToNormalizedTensor(object):
+    """
+    transforms.ToTensor() followed by transforms.Normalize(mean, std) as one op:
+    the uint8 RGB image is converted to a (C,H,W) float tensor in a single copy and scaled with the combined
+    per channel factor 1/(255*std) and offset -mean/std, instead of three passes (div, sub, div) over the float image
+    """
+    def __init__(self, mean, std):
+        std = torch.tensor(std, dtype=torch.float32)
+        self.mean = mean
+        self.std = std.tolist()
+        self.scale = (1.0 / (255.0 * std)).view(-1, 1, 1)
+        self.offset = (-torch.tensor(mean, dtype=torch.float32) / std).view(-1, 1, 1)
+
+    def __call__(self, pic):
+        if not (isinstance(pic, Image.Image) and pic.mode == 'RGB'):
+            ## other modes (grayscale, 16 bit, float) and inputs go through the unfused ToTensor and Normalize
+            from torchvision.transforms import functional as F
+            return F.normalize(F.to_tensor(pic), self.mean, self.std)
+        arr = torch.from_numpy(np.asarray(pic, dtype=np.uint8))
+        img = torch.empty((arr.size(2), arr.size(0), arr.size(1)), dtype=torch.float32)
+        img.copy_(arr.permute(2, 0, 1))
+        return img.mul_(self.scale).add_(self.offset)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
+
 def flip(x, dim):
     xsize = x.size()
     dim = x.dim() + dim if dim < 0 else dim
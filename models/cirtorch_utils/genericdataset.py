@@ -1,7 +1,12 @@
 import os
 import pdb
-import random
+import inspect
+import hashlib
+import threading
+from queue import Queue, Full
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import scipy.sparse
 
 import torch
 import torch.utils.data as data
@@ -12,15 +17,76 @@ from torch_geometric.data import Batch as GeoBatch
 
 
 from models.cirtorch_utils.datahelpers import default_loader, imresize
+## image datasets live without the torch_geometric dependency, re-exported for existing imports
+from models.cirtorch_utils.imagedataset import ImagesFromList, ImagesFromDataList
+
+def pos_batch(pos_list, follow_batch=[]):
+    """
+    GeoBatch.from_data_list([GeoData(pos=pos) for pos in pos_list], follow_batch) built directly:
+    one cat of the point clouds and the graph index vector, without a GeoData per sample
+    """
+    sizes = torch.tensor([pos.size(0) for pos in pos_list], dtype=torch.long)
+    batch = GeoBatch(batch=torch.repeat_interleave(torch.arange(len(pos_list)), sizes), pos=torch.cat(pos_list, dim=0))
+    if 'pos' in follow_batch:
+        batch['pos_batch'] = batch.batch
+    batch.__data_class__ = GeoData
+    batch.__slices__ = {'pos': [0] + sizes.cumsum(0).tolist()}
+    return batch
+
+def normalize_pos(pos, index, num_graphs, within_std=0.0, demean=True):
+    """
+    Outlier filter (points further than within_std standard deviations from the mean in any coordinate, if within_std > 0)
+    and demeaning to unit std per coordinate of every point cloud of the concatenated pos with graph index vector index.
+    Per graph moments are segment sums (index_add_), the same ops on cpu and gpu.
+    Returns the filtered pos and index
+    """
+    def center(pos, index):
+        count = torch.bincount(index, minlength=num_graphs).to(pos.dtype).unsqueeze(1)
+        centered = pos - (pos.new_zeros((num_graphs, pos.size(1))).index_add_(0, index, pos) / count)[index]
+        std = (pos.new_zeros((num_graphs, pos.size(1))).index_add_(0, index, centered * centered) / count).sqrt_()
+        return centered, std[index]
+    if within_std > 0:
+        centered, std = center(pos, index)
+        keep = (centered.abs() < within_std * std).all(dim=1)
+        pos, index = pos[keep], index[keep]
+    if demean:
+        pos, std = center(pos, index)
+        pos /= std
+    return pos, index
+
+def float_pos_batch(batch):
+    ## point clouds cached as float16 (PointCloudImagesFromList(half_points=True)) are upcast once they are on the device
+    if batch.pos.dtype == torch.float16:
+        batch.pos = batch.pos.float()
+    return batch
+
+def normalize_pos_batch(batch, within_std=0.0, demean=False):
+    """
+    normalize_pos on a batch of pos_batch (in place)
+    """
+    if within_std <= 0 and not demean:
+        return batch
+    float_pos_batch(batch)
+    batch.pos, batch.batch = normalize_pos(batch.pos, batch.batch, len(batch.__slices__['pos']) - 1, within_std, demean)
+    if within_std > 0:
+        if 'pos_batch' in batch:
+            batch['pos_batch'] = batch.batch
+        ## the filtered point counts are only known on the device of the batch
+        batch.__slices__ = None
+    return batch
 
 class PCDataLoader(data.DataLoader):
     
+    def __collate_pos__(self, pos_list, follow_batch):
+        batch = normalize_pos_batch(pos_batch(pos_list, follow_batch), *self.collate_normalize)
+        return float_pos_batch(batch) if self.collate_upcast else batch
+
     def __collate__(self, data_list, follow_batch=[]):
         img_pos = torch.stack([d[0] for d in data_list])
-        pt_pos = GeoBatch.from_data_list([GeoData(pos=d[1]) for d in data_list], follow_batch)
+        pt_pos = self.__collate_pos__([d[1] for d in data_list], follow_batch)
         if data_list[0][2] is not None:
             img_negs = torch.stack([d[2] for d in data_list])
-            pt_negs = GeoBatch.from_data_list([GeoData(pos=d[3]) for d in data_list], follow_batch)
+            pt_negs = self.__collate_pos__([d[3] for d in data_list], follow_batch)
         else:
             img_negs = None
             pt_negs = None
@@ -31,13 +97,151 @@ class PCDataLoader(data.DataLoader):
                  batch_size=1,
                  shuffle=False,
                  follow_batch=[],
+                 batched_fetch=False,
+                 demean=False,
+                 within_std=0.0,
                  **kwargs):
-        super(PCDataLoader, self).__init__(
-            dataset,
-            batch_size,
-            shuffle,
-            collate_fn=lambda data_list: self.__collate__(data_list, follow_batch),
-            **kwargs)
+        ## outlier filter and demeaning of the collated point clouds (normalize_pos)
+        self.collate_normalize = (within_std, demean)
+        ## float16 point clouds are upcast after the copy to the gpu, without cuda (no cpu half kernels) already in the collate
+        self.collate_upcast = not torch.cuda.is_available()
+        ## batches are copied into page-locked memory (by the loader in the main process, also with worker processes)
+        ## so the host to device copy can run with non_blocking=True
+        kwargs.setdefault('pin_memory', torch.cuda.is_available())
+        if kwargs.get('num_workers', 0) > 0 and 'persistent_workers' in inspect.signature(data.DataLoader.__init__).parameters:
+            ## torch >= 1.7: keep the workers alive between epochs instead of forking them again
+            kwargs.setdefault('persistent_workers', True)
+            kwargs.setdefault('prefetch_factor', 2)
+        if batched_fetch and hasattr(dataset, 'fetch_many'):
+            ## each worker fetches a whole batch with dataset.fetch_many (concurrent image reads),
+            ## the dataset is indexed with the index lists of a BatchSampler
+            sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+            batch_sampler = data.BatchSampler(sampler, batch_size, kwargs.pop('drop_last', False))
+            super(PCDataLoader, self).__init__(
+                BatchFetch(dataset, batch_sampler),
+                sampler=batch_sampler,
+                collate_fn=lambda batch_list: self.__collate__(batch_list[0], follow_batch),
+                **kwargs)
+        else:
+            super(PCDataLoader, self).__init__(
+                dataset,
+                batch_size,
+                shuffle,
+                collate_fn=lambda data_list: self.__collate__(data_list, follow_batch),
+                **kwargs)
+
+class BatchFetch(data.Dataset):
+    """
+    Dataset view whose items are whole batches: self[indices] = dataset.fetch_many(indices)
+    """
+    def __init__(self, dataset, batch_sampler):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+
+    def __getitem__(self, indices):
+        return self.dataset.fetch_many(indices)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+def background_iter(iterator, max_prefetch):
+    """
+    Runs iterator in a background thread, at most max_prefetch items ahead of the consumer.
+    Only the producer thread references iterator, it is released (a DataLoader iterator shuts its workers down)
+    as soon as the producer ends.
+    """
+    queue = Queue(max_prefetch)
+    stop = threading.Event()
+    end = object()
+    def put(item):
+        ## waits for space in the queue, gives up once the consumer stopped
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+    def produce(iterator):
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(end)
+    producer = threading.Thread(target=produce, args=(iterator,), daemon=True)
+    del iterator
+    producer.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        ## consumer stopped early (e.g. break in the training loop): end the producer and drop the queued batches
+        stop.set()
+        while producer.is_alive():
+            while not queue.empty():
+                queue.get_nowait()
+            producer.join(0.1)
+        while not queue.empty():
+            queue.get_nowait()
+
+def batch_tensors(batch):
+    """
+    All tensors of a collated batch, including the ones inside torch_geometric batches
+    """
+    for d in batch:
+        if torch.is_tensor(d):
+            yield d
+        elif d is not None:
+            for _, item in d():
+                if torch.is_tensor(item):
+                    yield item
+
+class PrefetchPCDataLoader(PCDataLoader):
+    """
+    PCDataLoader yielding batches that are already on the (CUDA) device.
+    Batches are collated in a background thread, the copy of the next batch runs on a side stream
+    while the current one is processed.
+    """
+    def __init__(self, dataset, batch_size=1, shuffle=False, follow_batch=[], device=None, max_prefetch=4, **kwargs):
+        super(PrefetchPCDataLoader, self).__init__(dataset, batch_size, shuffle, follow_batch, **kwargs)
+        self.device = torch.device('cuda') if device is None else device
+        self.max_prefetch = max_prefetch
+        ## point clouds are filtered and normalized on the device after the copy instead of in the workers
+        self.device_normalize, self.collate_normalize = self.collate_normalize, (0.0, False)
+
+    def __iter__(self):
+        batches = background_iter(super(PrefetchPCDataLoader, self).__iter__(), self.max_prefetch)
+        stream = torch.cuda.Stream(self.device)
+        def preload():
+            batch = next(batches, None)
+            if batch is not None:
+                with torch.cuda.stream(stream):
+                    batch = [d.to(self.device, non_blocking=True) if torch.is_tensor(d) else d if d is None else d.to(self.device) for d in batch]
+                    batch = [normalize_pos_batch(float_pos_batch(d), *self.device_normalize) if isinstance(d, GeoBatch) else d for d in batch]
+            return batch
+        try:
+            next_batch = preload()
+            while next_batch is not None:
+                current = torch.cuda.current_stream(self.device)
+                current.wait_stream(stream)
+                ## memory allocated on the side stream must not be reused before the current stream is done with it
+                for t in batch_tensors(next_batch):
+                    t.record_stream(current)
+                batch = next_batch
+                next_batch = preload()
+                yield batch
+        finally:
+            ## also when the consumer stops early: stop the producer and the loader workers, release the prefetched batch
+            batches.close()
+            next_batch = None
 
 class PointCloudSplit(data.Dataset):
     """
@@ -47,18 +251,20 @@ class PointCloudSplit(data.Dataset):
     """
     def __init__(self, point_list, val=False, split=15):
         self.point_list = point_list
-        self.idcs = []
-        for i in range(len(point_list)):
-            if i % split == 0:
-                if val:
-                    self.idcs.append(i)
-            else:
-                if not val:
-                    self.idcs.append(i)
+        idx = np.arange(len(point_list))
+        is_val = idx % split == 0
+        self.idcs = (idx[is_val] if val else idx[~is_val]).tolist()
         
     def __getitem__(self, index, val=False):
         idx = self.idcs[index]
         return self.point_list[idx]
+
+    def fetch_many(self, indices):
+        ## datasets without a batched fetch (e.g. Cambridge) are read sample by sample
+        idcs = [self.idcs[i] for i in indices]
+        if hasattr(self.point_list, 'fetch_many'):
+            return self.point_list.fetch_many(idcs)
+        return [self.point_list[i] for i in idcs]
     
     def __len__(self):
         return len(self.idcs)
@@ -72,225 +278,255 @@ class PointCloudImagesFromList(data.Dataset):
     Based on ImagesFromList
     """
     def __init__(self, root, images, points3d, imsize=None, transform=None, loader=default_loader, triplet=False, 
-                min_num_points=100, overfit=-1, max_std_std=0.1, within_std = 1.0, demean=True, deterministic=False):
-        self.image_ids = []
-        self.images_fn = []
+                min_num_points=100, overfit=-1, max_std_std=0.1, within_std = 1.0, demean=True, deterministic=False, fast_decode=False, io_threads=8,
+                cache_dir=None, half_points=False):
         self.overfit = overfit
         self.max_std_std = max_std_std
         self.within_std = within_std
         self.demean = demean
         self.deterministic = deterministic
+        ## all 3d points in one contiguous (N,3) array, _id_to_row maps point3D_id to its row
+        ## (shared copy-on-write by forked loader workers)
+        ids = np.fromiter(points3d.keys(), dtype=np.int64, count=len(points3d))
+        self._xyz = np.ascontiguousarray(np.stack([p.xyz for p in points3d.values()]), dtype=np.float64)
+        ## int32 rows: half the size of the lookup and of the per image rows, and the index type of the sparse incidence matrix
+        self._id_to_row = np.full(ids.max()+1, -1, dtype=np.int32)
+        self._id_to_row[ids] = np.arange(ids.shape[0], dtype=np.int32)
+        ## filtered (and normalized) point cloud of every kept image, computed once here instead of per sample
+        ## image k is _pts[_pts_offsets[k]:_pts_offsets[k+1]]
+        ## with cache_dir the arrays of the scan are stored in and loaded from an .npz next time
+        cache_file = None
+        if cache_dir is not None:
+            key = self.cache_key(root, images, ids, (min_num_points, overfit, max_std_std, within_std, demean))
+            cache_file = os.path.join(cache_dir, 'pointcloud_images_{}.npz'.format(key))
+        if cache_file is not None and os.path.exists(cache_file):
+            with np.load(cache_file) as cache:
+                image_ids, self._pts, self._pts_offsets = cache['image_ids'], cache['pts'], cache['pts_offsets']
+                self._rows, self._rows_offsets = cache['rows'], cache['rows_offsets']
+            self.image_ids = image_ids.tolist()
+        else:
+            self.scan_images(images, min_num_points)
+            if cache_file is not None:
+                np.savez(cache_file, image_ids=np.array(self.image_ids, dtype=np.int64), pts=self._pts, pts_offsets=self._pts_offsets,
+                         rows=self._rows, rows_offsets=self._rows_offsets)
+        if half_points:
+            ## half the memory and host to device traffic, the normalized coordinates are small (only sensible with demean)
+            self._pts = self._pts.astype(np.float16)
+        self.images_fn = [os.path.join(root,images[img].name) for img in self.image_ids]
+        if triplet:
+            self._neg_excluded, self._neg_offsets = self.overlapping_images()
+        self.root = root
+        self.images = images
+        self.points3d = points3d
+        self.imsize = imsize
+        self.transform = transform
+        self.loader = loader
+        ## fast_decode: jpegs are decoded at reduced scale when imsize allows it (loader has to accept imsize)
+        self.fast_decode = fast_decode
+        self.triplet = triplet
+        ## threads loading the images of fetch_many, the pool is created lazily in the process using it
+        self.io_threads = io_threads
+        self._io_pool = None
+        self._io_pool_pid = None
+        ## numpy random state drawing the negatives, created lazily per process like the pool
+        self._rng = None
+        self._rng_pid = None
+
+    def __getstate__(self):
+        """
+        The colmap images and points3d dicts (one python object per point) are only needed in __init__,
+        spawned loader workers get the packed numpy arrays without them
+        """
+        state = self.__dict__.copy()
+        state.pop('images', None)
+        state.pop('points3d', None)
+        state['_io_pool'] = None
+        state['_io_pool_pid'] = None
+        state['_rng'] = None
+        state['_rng_pid'] = None
+        return state
+
+    def io_pool(self):
+        ## threads do not survive a fork, forked loader workers create their own pool
+        if self._io_pool is None or self._io_pool_pid != os.getpid():
+            self._io_pool = ThreadPoolExecutor(max_workers=self.io_threads)
+            self._io_pool_pid = os.getpid()
+        return self._io_pool
+
+    def rng(self):
+        ## loader workers are seeded with distinct torch seeds (base_seed + worker_id), forked ones get their own state
+        if self._rng is None or self._rng_pid != os.getpid():
+            self._rng = np.random.RandomState(torch.initial_seed() % 2**32)
+            self._rng_pid = os.getpid()
+        return self._rng
+
+    def cache_key(self, root, images, point_ids, params):
+        """
+        Hash of everything the scan depends on: the filter parameters, the dataset root and the content of the
+        reconstruction (image ids with their observed point3D_ids, point ids and coordinates)
+        """
+        h = hashlib.md5(repr((root, len(images), len(point_ids), params)).encode())
+        h.update(np.fromiter(images.keys(), dtype=np.int64, count=len(images)).tobytes())
+        for img in images.values():
+            h.update(np.ascontiguousarray(img.point3D_ids, dtype=np.int64).tobytes())
+        h.update(point_ids.tobytes())
+        h.update(self._xyz.tobytes())
+        return h.hexdigest()
+
+    def scan_images(self, images, min_num_points):
+        """
+        Filters the point clouds of all images and keeps the ones with enough, not too anisotropic points
+        """
+        self.image_ids = []
+        pts_cache = []
+        pt_rows = []
         for i, img in enumerate(images.keys()):
-            if overfit > 0 and i > overfit:
+            if self.overfit > 0 and i > self.overfit:
                 break
             valid = images[img].point3D_ids > 0
+            num_valid = valid.sum()
+            if num_valid <= min_num_points:
+                continue
+            rows = self._id_to_row[images[img].point3D_ids[valid]]
+            pts = self.filter_points(self._xyz[rows])
             if self.max_std_std < float('inf'):                
-                pt_ids = images[img].point3D_ids[valid]
-                pts = np.stack([points3d[i].xyz for i in pt_ids])
-                mean, std = np.mean(pts, axis=0), np.std(pts, axis=0)
-                if self.within_std > 0:
-                    valid_pts = np.all(np.abs(pts - mean) < self.within_std*std, axis=1)
-                    pts = pts[valid_pts]
                 std = np.std(pts, axis=0)
                 std_std = np.std(std) / np.mean(std) ##normalize std
                 if std_std > self.max_std_std:
                     continue
-            num_valid = valid.sum()
-            if num_valid > min_num_points:
-                self.image_ids.append(img)
-                self.images_fn.append(os.path.join(root,images[img].name))
-        #self.image_ids = {i : k for i, k in enumerate(images.keys())}
-        #self.images_fn = [os.path.join(root,images[k].name) for i, k in self.image_ids.items()]
-        if len(self.images_fn) == 0:
+            self.image_ids.append(img)
+            pts_cache.append(self.normalize_points(pts).astype(np.float32))
+            pt_rows.append(rows)
+        if len(self.image_ids) == 0:
             raise(RuntimeError("Dataset contains 0 images!"))
-        self.root = root
-        self.images = images
-        self.points3d = points3d
-        self.imsize = imsize
-        self.transform = transform
-        self.loader = loader
-        self.triplet = triplet
-        random.seed(0)
-        
-    def __getitem__(self, index):
+        self._pts_offsets = np.zeros(len(pts_cache)+1, dtype=np.int64)
+        np.cumsum([p.shape[0] for p in pts_cache], out=self._pts_offsets[1:])
+        self._pts = np.concatenate(pts_cache)
+        ## point table rows of all valid points of image k: _rows[_rows_offsets[k]:_rows_offsets[k+1]]
+        self._rows_offsets = np.zeros(len(pt_rows)+1, dtype=np.int64)
+        np.cumsum([r.shape[0] for r in pt_rows], out=self._rows_offsets[1:])
+        self._rows = np.concatenate(pt_rows)
+
+    def get_xyz(self, pt_ids):
         """
-        Args:
-            index (int): Index
-
-        Returns:
-            image (PIL): Loaded image
+        Coordinates (N,3) of the given point3D_ids, a single gather from the point table
         """
-        path = self.images_fn[index]
-        img = self.loader(path)
-        imfullsize = max(img.size)
-
-        if self.imsize is not None:
-            img = imresize(img, self.imsize)
+        return self._xyz[self._id_to_row[pt_ids]]
 
-        if self.transform is not None:
-            img = self.transform(img)
-            
-        img_idx = self.image_ids[index]
-        valid = self.images[img_idx].point3D_ids > 0
-        pt_ids = self.images[img_idx].point3D_ids[valid]
-        pts = np.stack([self.points3d[i].xyz for i in pt_ids])
-        mean, std = np.mean(pts, axis=0), np.std(pts, axis=0)
+    def overlapping_images(self, max_overlap=0.01):
+        """
+        Images that are no valid negative of image k because they share at least max_overlap of its 3d points,
+        as sorted ragged array excluded[offsets[k]:offsets[k+1]] (image k itself included).
+        Shared points of all image pairs come from one sparse product of the image x point incidence matrix.
+        """
+        num_images = len(self.image_ids)
+        num_pts = np.diff(self._rows_offsets)
+        incidence = scipy.sparse.csr_matrix((np.ones(self._rows.shape[0], dtype=np.int32), self._rows, self._rows_offsets),
+                                            shape=(num_images, self._xyz.shape[0]))
+        shared = incidence.dot(incidence.T).tocsr()
+        shared.sort_indices()
+        row_of = np.repeat(np.arange(num_images), np.diff(shared.indptr))
+        excluded = shared.data >= num_pts[row_of] * max_overlap
+        offsets = np.zeros(num_images+1, dtype=np.int64)
+        np.cumsum(np.bincount(row_of[excluded], minlength=num_images), out=offsets[1:])
+        return shared.indices[excluded].astype(np.int64), offsets
+
+    def sample_negative(self, index, rng=None):
+        """
+        Uniformly samples an image sharing less than 1% of the 3d points of image index.
+        The r-th not excluded image is r plus the number of excluded images before it, found by bisection.
+        In deterministic mode the draw only depends on index, otherwise it comes from the random state of the process.
+        """
+        if rng is None:
+            rng = np.random.RandomState(index) if self.deterministic else self.rng()
+        excluded = self._neg_excluded[self._neg_offsets[index]:self._neg_offsets[index+1]]
+        num_candidates = len(self.image_ids) - excluded.shape[0]
+        if num_candidates < 1:
+            raise(RuntimeError("No negative sample for image {}".format(self.image_ids[index])))
+        r = int(rng.randint(num_candidates))
+        return r + int(np.searchsorted(excluded - np.arange(excluded.shape[0]), r, side='right'))
+
+    def filter_points(self, pts):
+        """
+        Removes points further than within_std standard deviations from the mean (in any coordinate)
+        """
         if self.within_std > 0:
-            valid_pts = np.all(np.abs(pts - mean) < self.within_std*std, axis=1)
+            mean, std = np.mean(pts, axis=0), np.std(pts, axis=0)
+            thresh = self.within_std*std
+            ## abs in place and the per coordinate tests accumulated into one (N,) mask,
+            ## instead of three (N,3) temporaries of np.all(np.abs(pts - mean) < thresh, axis=1)
+            dist = pts - mean
+            np.abs(dist, out=dist)
+            valid_pts = dist[:, 0] < thresh[0]
+            for c in range(1, dist.shape[1]):
+                valid_pts &= dist[:, c] < thresh[c]
             pts = pts[valid_pts]
-        if self.demean:
-            pts -= np.mean(pts, axis=0)
-            pts /= np.std(pts, axis=0) 
-        pts = torch.from_numpy(pts)
-        
-        if self.triplet: # return point cloud with little overlap for negative triplet loss
-            if self.deterministic:
-                random.seed(index)
-            while True:
-                j = random.randint(0, len(self.image_ids) - 1) # random.choice(enumerate(self.image_ids))
-                trp_idx = self.image_ids[j]
-                valid_trp = self.images[trp_idx].point3D_ids > 0
-                pt_ids_trp = self.images[trp_idx].point3D_ids[valid_trp]
-                shared = np.intersect1d(pt_ids, pt_ids_trp, assume_unique=True)
-                if shared.shape[0] < pt_ids.shape[0] * 0.01:
-                    break
-            pts_trp = np.stack([self.points3d[i].xyz for i in pt_ids_trp])
-            mean, std = np.mean(pts_trp, axis=0), np.std(pts_trp, axis=0)
-            if self.within_std > 0:
-                valid_pts = np.all(np.abs(pts_trp - mean) < self.within_std*std, axis=1)
-                pts_trp = pts_trp[valid_pts]
-            if self.demean:
-                pts_trp -= np.mean(pts_trp, axis=0)
-                pts_trp /= np.std(pts_trp, axis=0) 
-            pts_trp = torch.from_numpy(pts_trp).float()
-            path_trp = self.images_fn[j]
-            img_trp = self.loader(path_trp)
-            imfullsize_trp = max(img_trp.size)
-            if self.imsize is not None:
-                img_trp = imresize(img_trp, self.imsize)
-
-            if self.transform is not None:
-                img_trp = self.transform(img_trp)
-        else:
-            pts_trp = None
-            img_trp = None
-
-        return [img, pts.float(), img_trp, pts_trp] # {'anchor':img, 'pos':pts, 'neg':pts_trp}
-    
-    def __len__(self):
-        return len(self.images_fn)
-
-
-class ImagesFromList(data.Dataset):
-    """A generic data loader that loads images from a list 
-        (Based on ImageFolder from pytorch)
-
-    Args:
-        root (string): Root directory path.
-        images (list): Relative image paths as strings.
-        imsize (int, Default: None): Defines the maximum size of longer image side
-        bbxs (list): List of (x1,y1,x2,y2) tuples to crop the query images
-        transform (callable, optional): A function/transform that  takes in an PIL image
-            and returns a transformed version. E.g, ``transforms.RandomCrop``
-        loader (callable, optional): A function to load an image given its path.
-
-     Attributes:
-        images_fn (list): List of full image filename
-    """
-
-    def __init__(self, root, images, imsize=None, bbxs=None, transform=None, loader=default_loader):
+        return pts
 
-        images_fn = [os.path.join(root,images[i]) for i in range(len(images))]
-
-        if len(images_fn) == 0:
-            raise(RuntimeError("Dataset contains 0 images!"))
-
-        self.root = root
-        self.images = images
-        self.imsize = imsize
-        self.images_fn = images_fn
-        self.bbxs = bbxs
-        self.transform = transform
-        self.loader = loader
+    def normalize_points(self, pts):
+        if self.demean:
+            pts = pts - np.mean(pts, axis=0)
+            pts /= np.std(pts, axis=0)
+        return pts
 
-    def __getitem__(self, index):
+    def get_points(self, index):
         """
-        Args:
-            index (int): Index
-
-        Returns:
-            image (PIL): Loaded image
+        Cached float32 (float16 with half_points) point cloud of sample index as tensor (a copy, the cache stays untouched)
         """
-        path = self.images_fn[index]
-        img = self.loader(path)
-        imfullsize = max(img.size)
+        return torch.from_numpy(self._pts[self._pts_offsets[index]:self._pts_offsets[index+1]].copy())
 
-        if self.bbxs is not None:
-            img = img.crop(self.bbxs[index])
+    def load_image(self, index):
+        path = self.images_fn[index]
+        if self.fast_decode and self.imsize is not None:
+            img = self.loader(path, self.imsize)
+        else:
+            img = self.loader(path)
 
         if self.imsize is not None:
-            if self.bbxs is not None:
-                img = imresize(img, self.imsize * max(img.size) / imfullsize)
-            else:
-                img = imresize(img, self.imsize)
+            img = imresize(img, self.imsize)
 
         if self.transform is not None:
             img = self.transform(img)
-
         return img
-
-    def __len__(self):
-        return len(self.images_fn)
-
-    def __repr__(self):
-        fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
-        fmt_str += '    Number of images: {}\n'.format(self.__len__())
-        fmt_str += '    Root Location: {}\n'.format(self.root)
-        tmp = '    Transforms (if any): '
-        fmt_str += '{0}{1}\n'.format(tmp, self.transform.__repr__().replace('\n', '\n' + ' ' * len(tmp)))
-        return fmt_str
-
-class ImagesFromDataList(data.Dataset):
-    """A generic data loader that loads images given as an array of pytorch tensors
-        (Based on ImageFolder from pytorch)
-
-    Args:
-        images (list): Images as tensors.
-        transform (callable, optional): A function/transform that image as a tensors
-            and returns a transformed version. E.g, ``normalize`` with mean and std
-    """
-
-    def __init__(self, images, transform=None):
-
-        if len(images) == 0:
-            raise(RuntimeError("Dataset contains 0 images!"))
-
-        self.images = images
-        self.transform = transform
-
+        
     def __getitem__(self, index):
         """
         Args:
             index (int): Index
 
         Returns:
-            image (Tensor): Loaded image
+            image (PIL): Loaded image
         """
-        img = self.images[index]
-        if self.transform is not None:
-            img = self.transform(img)
-
-        if len(img.size()):
-            img = img.unsqueeze(0)
+        img = self.load_image(index)
+        pts = self.get_points(index)
+        
+        if self.triplet: # return point cloud with little overlap for negative triplet loss
+            j = self.sample_negative(index)
+            pts_trp = self.get_points(j)
+            img_trp = self.load_image(j)
+        else:
+            pts_trp = None
+            img_trp = None
 
-        return img
+        return [img, pts, img_trp, pts_trp] # {'anchor':img, 'pos':pts, 'neg':pts_trp}
 
+    def fetch_many(self, indices):
+        """
+        Samples [self[i] for i in indices], the images (anchors and negatives) are loaded concurrently
+        by the io thread pool so the disk reads and jpeg decodes of the batch overlap
+        """
+        negatives = []
+        if self.triplet:
+            for index in indices:
+                negatives.append(self.sample_negative(index))
+        imgs = list(self.io_pool().map(self.load_image, list(indices) + negatives))
+        samples = []
+        for k, index in enumerate(indices):
+            if self.triplet:
+                samples.append([imgs[k], self.get_points(index), imgs[len(indices)+k], self.get_points(negatives[k])])
+            else:
+                samples.append([imgs[k], self.get_points(index), None, None])
+        return samples
+    
     def __len__(self):
-        return len(self.images)
-
-    def __repr__(self):
-        fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
-        fmt_str += '    Number of images: {}\n'.format(self.__len__())
-        tmp = '    Transforms (if any): '
-        fmt_str += '{0}{1}\n'.format(tmp, self.transform.__repr__().replace('\n', '\n' + ' ' * len(tmp)))
-        return fmt_str
\ No newline at end of file
+        return len(self.images_fn)
@@ -224,19 +224,31 @@ class SuperPointFrontend(object):
       """
     assert img.ndim == 2, 'Image must be grayscale.'
     assert img.dtype == np.float32, 'Image must be float32.'
-    H, W = img.shape[0], img.shape[1]
-    inp = img.copy()
-    inp = (inp.reshape(1, H, W))
-    inp = torch.from_numpy(inp)
-    inp = torch.autograd.Variable(inp).view(1, 1, H, W)
+    return self.run_batch(img[np.newaxis], None if points is None else [points])[0]
+
+  def run_batch(self, imgs, points=None):
+    """ Process a batch of equally sized images with a single forward pass.
+    Input
+      imgs - BxHxW numpy array or torch tensor (float32, range [0,1]).
+      points - optional list of B Nx2 arrays of given keypoints.
+    Output
+      List of B (corners, desc, heatmap) tuples as returned by run.
+      """
+    B, H, W = imgs.shape[0], imgs.shape[1], imgs.shape[2]
+    inp = torch.as_tensor(imgs).float().view(B, 1, H, W)
     if self.cuda:
-      inp = inp.cuda()
+      inp = inp.cuda(non_blocking=True)
     # Forward pass of network.
-    outs = self.net.forward(inp)
+    with torch.no_grad():
+      outs = self.net.forward(inp)
     semi, coarse_desc = outs[0], outs[1]
-    D = coarse_desc.shape[1]
     # Convert pytorch -> numpy.
-    semi = semi.data.cpu().numpy().squeeze()
+    semi = semi.data.cpu().numpy()
+    return [self.process_output(semi[b], coarse_desc[b:b+1], H, W, None if points is None else points[b]) for b in range(B)]
+
+  def process_output(self, semi, coarse_desc, H, W, points=None):
+    """ Keypoints (NMS) and descriptors of a single image from the network output. """
+    D = coarse_desc.shape[1]
     if points is None:
         # --- Process points.
         dense = np.exp(semi) # Softmax.
@@ -269,7 +281,7 @@ class SuperPointFrontend(object):
         # --- Process descriptor.
     else:
         pts = points.T
-        heatmap = np.zeros_like(img)
+        heatmap = np.zeros((H, W), dtype=np.float32)
     if pts.shape[1] == 0:
       desc = np.zeros((D, 0))
     else:
@@ -2,6 +2,7 @@
 This script is processing user input and setting up training process accordingly. 
 """
 
+import os
 import configparser
 import argparse
 import torch
@@ -14,7 +15,8 @@ import models.hfnet as hfnet
 import numpy as np
 import random
 
-from models.cirtorch_utils.genericdataset import PointCloudImagesFromList, PointCloudSplit, PCDataLoader
+from models.cirtorch_utils.genericdataset import PointCloudImagesFromList, PointCloudSplit, PCDataLoader, PrefetchPCDataLoader
+from models.cirtorch_utils.datahelpers import ToNormalizedTensor
 from models.decoder import DecoderV2
 
 import models.pointnet2_classification as ptnet
@@ -54,15 +56,12 @@ overfit = cp['Training'].getint('overfit', -1)
 
 stats_file = cp['DataParams'].get('stats_file')
 stats = np.loadtxt(stats_file)
-normalize = transforms.Normalize(
-   mean=stats[0],
-   std=stats[1]
-)
+## ToTensor and Normalize in one op
+to_normalized_tensor = ToNormalizedTensor(mean=stats[0], std=stats[1])
 transform = transforms.Compose([
         transforms.Resize(cp['DataParams'].getint('input_size', 1024)),
         transforms.CenterCrop(cp['DataParams'].getint('input_size', 1024)),
-        transforms.ToTensor(),
-        normalize
+        to_normalized_tensor
 ])
 ## Initialize dataset & preprocessing
 if args.dataset == 'Aachen':
@@ -72,25 +71,38 @@ if args.dataset == 'Aachen':
     dataset = PointCloudImagesFromList('data/AachenDayNight/images_upright', images, points3d,
                                        imsize=cp['DataParams'].getint('input_size', 1024), transform=transform, 
                                        triplet=True, min_num_points=cp['Training'].getint('min_num_3dpts', 100), 
-                                       max_std_std=0.1, within_std=2.0,deterministic= overfit > 0
+                                       max_std_std=0.1, within_std=2.0,deterministic= overfit > 0,
+                                       fast_decode=cp['DataParams'].getboolean('fast_decode', False),
+                                       cache_dir=cp['DataParams'].get('cache_dir', None),
+                                       half_points=cp['DataParams'].getboolean('half_points', False)
                                       )
 elif args.dataset == 'ShopFacade':
     from dataset_loaders import cambridge
+    ## point clouds are demeaned batched in the collate instead of per sample
     dataset = cambridge.Cambridge(imsize=cp['DataParams'].getint('input_size', 1024), transform=transform, 
-                                       triplet=True, deterministic=(overfit > 0))
+                                       triplet=True, deterministic=(overfit > 0), demean=False)
     
 do_val = cp['Training'].getboolean('validation', True)
+## copy batches to the gpu on a side stream while the previous batch is processed
+Loader = PrefetchPCDataLoader if cp['Training'].getboolean('prefetch', torch.cuda.is_available()) else PCDataLoader
+## training batches fetched as a whole, with the images of a batch read concurrently
+batched_fetch = cp['DataParams'].getboolean('batched_fetch', False)
+## worker processes of the training loader (forked, sharing the dataset copy-on-write), none for overfitting
+num_workers = cp['Training'].getint('num_workers', min(8, os.cpu_count()) if overfit < 0 else 0)
+## Cambridge point clouds are filtered and normalized batched by the loader (on the gpu with prefetch),
+## Aachen ones are cached normalized by the dataset
+pts_normalize = dict(demean=True, within_std=cp['DataParams'].getfloat('within_std', 0.0)) if args.dataset == 'ShopFacade' else {}
 if do_val:
     dataset_split = PointCloudSplit(dataset, val=False, split=cp['Training'].getint('val_split', 10))
-    dataloader = PCDataLoader(dataset_split, batch_size=cp['Training'].getint('batch_size', 10) if overfit < 0 else 1, shuffle=True if overfit < 0 else False)
+    dataloader = Loader(dataset_split, batch_size=cp['Training'].getint('batch_size', 10) if overfit < 0 else 1, shuffle=True if overfit < 0 else False, batched_fetch=batched_fetch, num_workers=num_workers, **pts_normalize)
         
     if overfit >= 0:
         val_loader = dataloader # PCDataLoader(dataset_split, batch_size=1, shuffle=False)
     else:
         val_set = PointCloudSplit(dataset, val=True, split=cp['Training'].getint('val_split', 10))
-        val_loader = PCDataLoader(val_set, batch_size=1, shuffle=False)
+        val_loader = Loader(val_set, batch_size=1, shuffle=False, **pts_normalize)
 else:
-    dataloader = PCDataLoader(dataset, batch_size=cp['Training'].getint('batch_size', 10), shuffle=True)
+    dataloader = Loader(dataset, batch_size=cp['Training'].getint('batch_size', 10), shuffle=True, batched_fetch=batched_fetch, num_workers=num_workers, **pts_normalize)
         
 """
 elif args.dataset == 'MNIST': ## this was for validating training pipeline